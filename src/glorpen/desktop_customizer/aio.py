@@ -0,0 +1,71 @@
+import asyncio
+import concurrent.futures
+import functools
+import logging
+import typing
+from datetime import timedelta
+
+
+async def wait_readable(fd: int):
+    """Suspends until given file descriptor has data to read."""
+    loop = asyncio.get_running_loop()
+    fut = loop.create_future()
+
+    def on_ready():
+        if not fut.done():
+            fut.set_result(None)
+
+    loop.add_reader(fd, on_ready)
+    try:
+        await fut
+    finally:
+        loop.remove_reader(fd)
+
+
+class Worker(object):
+    """
+    Runs blocking calls (X replies, netlink queries) in a dedicated thread.
+
+    Calls are executed one at a time and in order, so a hung call delays only its own subsystem.
+
+    Running call cannot be interrupted, so after a timeout it is left in its thread and the worker switches to a new one.
+    Calls queued behind it are dropped with :class:`asyncio.TimeoutError`.
+    """
+
+    def __init__(self, name: str, timeout: typing.Optional[timedelta] = None):
+        super().__init__()
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.name = name
+        self.timeout = timeout
+        self._executor = self._create_executor()
+
+    def _create_executor(self):
+        return concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix=self.name)
+
+    def _replace_executor(self, executor: concurrent.futures.Executor, fn, timeout: timedelta):
+        # calls queued behind hung one time out too, only the first one replaces thread
+        if self._executor is not executor:
+            return
+        self.logger.warning("%s: call %r did not finish in %s, moving to a new thread", self.name, fn, timeout)
+        self._executor = self._create_executor()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    async def call(self, fn, *args, timeout: typing.Optional[timedelta] = None, **kwargs):
+        """Awaits result of ``fn(*args, **kwargs)``, raises :class:`asyncio.TimeoutError` when it takes too long."""
+        timeout = self.timeout if timeout is None else timeout
+        executor = self._executor
+        fut = asyncio.get_running_loop().run_in_executor(executor, functools.partial(fn, *args, **kwargs))
+        try:
+            return await asyncio.wait_for(fut, timeout.total_seconds() if timeout else None)
+        except asyncio.TimeoutError:
+            self._replace_executor(executor, fn, timeout)
+            raise
+        except asyncio.CancelledError:
+            # queued call was dropped by executor replacement, caller itself was not cancelled
+            if fut.cancelled() and not asyncio.current_task().cancelling():
+                raise asyncio.TimeoutError() from None
+            raise
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
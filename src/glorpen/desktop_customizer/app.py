@@ -1,105 +1,329 @@
 import asyncio
+import dataclasses
+import datetime
 import logging
+import os
+import pathlib
+import sys
+import typing
+
+from xcffib.randr import Rotation
 
 from glorpen.desktop_customizer.automation.dimmer import Dimmer
-from glorpen.desktop_customizer.layout import Placement, LayoutManager, Layout
-from glorpen.desktop_customizer.wallpaper import ImageFinder, PictureWriter, Monitor, DictCache
-from glorpen.desktop_customizer.whereami.detection import DetectionInfo
-from glorpen.desktop_customizer.whereami.hints.simple import WifiHint, HostHint
-from glorpen.desktop_customizer.whereami.hints.xrand import ScreenHint, MonitorHint
+from glorpen.desktop_customizer.commands import CommandDispatcher
+from glorpen.desktop_customizer.config.model import Loader, MainConfig, NestedConfig, MonitorConfig, \
+    DynamicMonitorConfig, FileConfig, CommandConfig, WallpaperConfig
+from glorpen.desktop_customizer.config.reload import ConfigReloader, ConfigDiff
+from glorpen.desktop_customizer.config.selectors import SelectorIndex
+from glorpen.desktop_customizer.config.templating import get_cache_dir, get_environment
+from glorpen.desktop_customizer.files import FileRenderer
+from glorpen.desktop_customizer.layout import Placement, LayoutManager, Layout, get_rotated_sizing
+from glorpen.desktop_customizer.aio import Worker
+from glorpen.desktop_customizer.wallpaper import ImageFinder, PictureWriter, Monitor, DictCache, SqliteCache, \
+    RenderCache
+from glorpen.desktop_customizer.whereami.detection import DetectionInfo, DetectionEvent
+from glorpen.desktop_customizer.whereami.hints import WifiHint, HostHint, MonitorHint
+from glorpen.desktop_customizer.xserver import XConnection
+
+_ROTATIONS = {
+    0: Rotation.Rotate_0,
+    90: Rotation.Rotate_90,
+    180: Rotation.Rotate_180,
+    270: Rotation.Rotate_270,
+}
+
+
+def _get_monitor(m: MonitorHint, name=None) -> Monitor:
+    return Monitor(m.screen.x, m.screen.y, m.screen.width, m.screen.height, name=name)
 
 
 class WallpaperManager(object):
-    def __init__(self, path):
+    def __init__(self, path, index_path=None):
         super().__init__()
-        self.finder = ImageFinder(path, cache=DictCache())
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.path = path
+        self.finder = ImageFinder(path, cache=SqliteCache(index_path) if index_path else DictCache())
+        self.renders = RenderCache()
+        # output name -> image
         self.cache = {}
+        self._worker = Worker(self.__class__.__name__)
+        self._watcher: typing.Optional[asyncio.Future] = None
 
-    async def set_wallpapers(self, screens, *args):
-        new_screens = []
+    def start(self):
+        self._watcher = asyncio.ensure_future(self.finder.watch())
 
-        p = PictureWriter()
-        p.connect()
+    async def close(self):
+        if self._watcher:
+            self._watcher.cancel()
+            await asyncio.gather(self._watcher, return_exceptions=True)
+        await self.finder.close()
+        self._worker.shutdown()
 
-        for s in screens.values():
-            output = s.physical.output
-            if output in self.cache:
-                p.set_picture(
-                    self.cache[output],
-                    Monitor(s.x, s.y, s.width, s.height, name=s.physical.output_name)
-                )
+    def _write(self, pictures):
+        p = PictureWriter(cache=self.renders)
+        p.connect()
+        try:
+            for img, monitor in pictures:
+                p.set_picture(img, monitor)
+            p.write()
+        finally:
+            p.disconnect()
+
+    async def set_wallpapers(self, monitors: typing.Iterable[MonitorHint]):
+        monitors = tuple(monitors)
+        try:
+            await self._set_wallpapers(monitors)
+        except FileNotFoundError as e:
+            # image was removed after it was chosen, so other ones are used
+            self.logger.info("Image %s is gone, choosing another one", e.filename)
+            for name, image in tuple(self.cache.items()):
+                if not image.exists():
+                    del self.cache[name]
+            await self._set_wallpapers(monitors)
+
+    async def _set_wallpapers(self, monitors: typing.Iterable[MonitorHint]):
+        pictures = []
+        new_monitors = []
+
+        for m in monitors:
+            if not m.screen:
+                continue
+            if m.output_name in self.cache:
+                pictures.append((self.cache[m.output_name], _get_monitor(m, m.output_name)))
             else:
-                new_screens.append(s)
+                new_monitors.append(m)
 
-        if new_screens:
-            new_images = self.finder.get_unique_random(len(new_screens), self.cache.values())
+        if new_monitors:
+            new_images = await self.finder.get_unique_random(
+                len(new_monitors),
+                self.cache.values(),
+                monitors=[_get_monitor(m) for m in new_monitors]
+            )
 
-            for co, img in itertools.zip_longest(new_screens, new_images):
-                self.cache[co.physical.output] = img
-                p.set_picture(
-                    img,
-                    Monitor(co.x, co.y, co.width, co.height, name=co.physical.output_name)
-                )
+            for m, img in zip(new_monitors, new_images):
+                self.cache[m.output_name] = img
+                pictures.append((img, _get_monitor(m, m.output_name)))
 
-        p.write()
-        p.disconnect()
+        if not pictures:
+            return
+
+        # decoding and scaling images not found in render cache takes a while
+        await self._worker.call(self._write, pictures)
 
 
-from glorpen.desktop_customizer.config import reader as config_reader
-import itertools
+class ActionScheduler(object):
+    """
+    Runs actions of single event concurrently.
 
+    Action waits only for earlier actions of kinds it depends on - ones listed in its ``after`` attribute
+    and in ``after`` key of its config.
+    """
 
-class ActionCallback(object):
-    def __init__(self, condition, action, watch, events, actions):
+    def __init__(self, actions, concurrency=4):
         super().__init__()
-        self.condition = condition
-        self.action = action
-        self.watch = watch
-        self.events = events
+        self.logger = logging.getLogger(self.__class__.__name__)
+
         self.actions = actions
+        self._semaphore = asyncio.Semaphore(concurrency)
 
-    async def __call__(self, *args):
-        kwargs = dict(i for i in itertools.zip_longest(self.events, args))
+    async def _run(self, kind, action, dependencies, kwargs, params):
+        if dependencies:
+            try:
+                await asyncio.gather(*dependencies)
+            except Exception:
+                self.logger.warning("Skipping %r action, one of its dependencies failed", kind)
+                raise
 
-        if not self.condition(**kwargs):
-            print("skipping", kwargs)
-            return
+        async with self._semaphore:
+            await action.do(**kwargs, **params)
 
-        if self.watch:
-            print(self.watch)
-        # TODO: check watch values for changes since last time
+    async def run(self, entries, kwargs):
+        scheduled = []
 
-        for a in self.action:
+        for a in entries:
             for k, v in a.items():
-                if k in self.actions:
-                    await self.actions[k].do(**kwargs, **v)
-                else:
-                    print("Unknown action %r" % k)
+                if k not in self.actions:
+                    self.logger.warning("Unknown action %r", k)
+                    continue
+
+                action = self.actions[k]
+                params = dict(v)
+                after = set(params.pop("after", ())).union(getattr(action, "after", ()))
+                dependencies = [t for kind, t in scheduled if kind in after]
+
+                scheduled.append((k, asyncio.ensure_future(self._run(k, action, dependencies, kwargs, params))))
+
+        results = await asyncio.gather(*(t for _, t in scheduled), return_exceptions=True)
+
+        errors = []
+        for (kind, _), result in zip(scheduled, results):
+            if isinstance(result, BaseException):
+                self.logger.error("Action %r failed: %r", kind, result)
+                errors.append(result)
+        if errors:
+            raise errors[0]
+
+
+def get_context(state) -> typing.Dict[str, typing.Any]:
+    """Variables for selectors and templates, built from detection state."""
+    wifi = state.get(WifiHint) or ()
+    return {
+        "host": state.get(HostHint),
+        # first interface connected to a network
+        "wifi": next((w for w in wifi if w.ssid), None),
+        "monitors": tuple(m for m in state.get(MonitorHint) or () if m.connected),
+    }
+
+
+@dataclasses.dataclass(frozen=True, eq=False)
+class ActiveConfig:
+    """Main config with sections of matched places applied over it, entries of later places win."""
+    places: typing.Tuple[str, ...]
+    # rules of places come before main ones
+    monitors: typing.Mapping[str, typing.Union[MonitorConfig, DynamicMonitorConfig]]
+    files: typing.Mapping[str, FileConfig]
+    commands: typing.Mapping[str, CommandConfig]
+    wallpaper: typing.Optional[WallpaperConfig]
+    monitor_index: SelectorIndex
+
+    @classmethod
+    def merge(cls, places: typing.Tuple[str, ...], configs: typing.Sequence[NestedConfig]) -> "ActiveConfig":
+        monitors = {}
+        files = {}
+        commands = {}
+        wallpaper = None
+
+        for config in reversed(configs):
+            for k, v in config.monitors.items():
+                monitors.setdefault(k, v)
+            for k, v in config.files.items():
+                files.setdefault(k, v)
+            for k, v in config.commands.items():
+                commands.setdefault(k, v)
+            # wallpaper section defaults to empty dict
+            if wallpaper is None and isinstance(config.wallpaper, WallpaperConfig) and config.wallpaper.dir:
+                wallpaper = config.wallpaper
+
+        return cls(
+            places=places,
+            monitors=monitors,
+            files=files,
+            commands=commands,
+            wallpaper=wallpaper,
+            monitor_index=SelectorIndex(
+                dict((k, v.selector) for k, v in monitors.items() if isinstance(v, MonitorConfig))
+            ),
+        )
+
+
+class PlaceMatcher(object):
+    """Finds places matching detection context, configs are merged once for each set of matched places."""
+
+    def __init__(self, config: MainConfig):
+        super().__init__()
+        self.config = config
+        self._index = SelectorIndex(dict((name, place.selector) for name, place in config.places.items()))
+        self._active: typing.Dict[typing.Tuple[str, ...], ActiveConfig] = {}
+
+    def match(self, context: typing.Mapping[str, typing.Any]) -> ActiveConfig:
+        names = tuple(self._index.match(**context))
+        active = self._active.get(names)
+        if active is None:
+            active = self._active[names] = ActiveConfig.merge(
+                names, [self.config] + [self.config.places[name] for name in names]
+            )
+        return active
 
 
 class WallpaperAction(object):
-    def __init__(self, wm):
+    # wallpapers are placed on current screen geometry
+    after = ("layout",)
+
+    def __init__(self, index_path: typing.Optional[pathlib.Path] = None):
         super().__init__()
 
-        self.wm = wm
+        self.index_path = index_path
+        self.wm: typing.Optional[WallpaperManager] = None
+
+    async def _get_manager(self, config: typing.Optional[WallpaperConfig]) -> typing.Optional[WallpaperManager]:
+        directory = config.dir if config else None
+        if self.wm and self.wm.path != directory:
+            await self.close()
+        if directory and not self.wm:
+            self.wm = WallpaperManager(directory, self.index_path)
+            self.wm.start()
+        return self.wm
 
-    async def do(self, screen, safe, **kwargs):
-        await self.wm.set_wallpapers(screen)
+    async def do(self, config: ActiveConfig, monitors, **kwargs):
+        wm = await self._get_manager(config.wallpaper)
+        if wm:
+            await wm.set_wallpapers(monitors)
+
+    async def close(self):
+        if self.wm:
+            await self.wm.close()
+            self.wm = None
 
 
 class DynamicLayout(Layout):
+    """
+    Placements of outputs by their name.
+
+    Outputs listed in ``dynamic`` are put left or right of placed ones, in given order.
+    """
+
     def __init__(self):
         super().__init__()
 
-        self.placements = {}
+        self.placements: typing.Dict[str, Placement] = {}
+        self.dynamic: typing.Tuple[typing.Tuple[str, str], ...] = ()
+        self._resolved: typing.Dict[int, Placement] = {}
 
-    def fit(self, hints):
-        self.hints = hints
+    def fit(self, layout_hints):
+        hints = dict((h.output_name, h) for h in layout_hints)
+        placements = dict((n, p) for n, p in self.placements.items() if n in hints)
+        dynamic = [(n, side) for n, side in self.dynamic if n in hints and n not in placements]
+
+        if not placements and not dynamic:
+            return False
+
+        def get_width(name, placement):
+            return get_rotated_sizing(placement.rotation, (hints[name].width, hints[name].height))[0]
+
+        right = max((p.position[0] + get_width(n, p) for n, p in placements.items()), default=0)
+        top = min((p.position[1] for p in placements.values()), default=0)
+
+        left_names = [n for n, side in dynamic if side == "left"]
+        # screen cannot have negative coordinates, so placed outputs are moved to make room
+        shift = sum(hints[n].width for n in left_names)
+
+        resolved = dict(
+            (n, Placement(position=[p.position[0] + shift, p.position[1]], rotation=p.rotation, primary=p.primary))
+            for n, p in placements.items()
+        )
+
+        x = 0
+        for n in left_names:
+            resolved[n] = Placement(position=[x, top])
+            x += hints[n].width
+
+        x = right + shift
+        for n, side in dynamic:
+            if side == "right":
+                resolved[n] = Placement(position=[x, top])
+                x += hints[n].width
+
+        if not any(p.primary for p in resolved.values()):
+            resolved[dynamic[0][0] if dynamic else next(iter(resolved))].primary = True
+
+        self._resolved = dict((hints[n].output, p) for n, p in resolved.items())
         return True
 
     def get_placement_for_output(self, output):
-        if output in self.placements:
-            return self.placements[output]
+        return self._resolved.get(output)
+
+    def get_fingerprint(self):
+        return tuple(sorted((name, p.get_fingerprint()) for name, p in self.placements.items())), self.dynamic
 
 
 class LayoutAction(object):
@@ -109,73 +333,223 @@ class LayoutAction(object):
         self.lm = lm
         self.dl = dl
 
-    async def do(self, monitor, monitors, **kwargs):
+    @classmethod
+    def get_placements(cls, config: ActiveConfig, monitors: typing.Iterable[MonitorHint], context):
+        """Returns placements of monitors matched by rules, and dynamic placements of remaining ones."""
+        order = dict((name, index) for index, name in enumerate(config.monitors))
+        matched = {}
+        unmatched = []
+
+        for m in monitors:
+            # only rules that could match this monitor are evaluated
+            name = next((n for n in config.monitor_index.match(**context, monitor=m) if n not in matched), None)
+            if name is None:
+                unmatched.append(m.output_name)
+            else:
+                matched[name] = m.output_name
+
         placements = {}
-        for m in monitor.values():
-            for cm in monitors:
-                if cm["output"] is not None and cm["output"] != m.output_name:
-                    continue
-                if cm["name"] is not None and cm["name"] != m.monitor_name:
-                    continue
-                if cm["serial"] is not None and cm["serial"] != m.monitor_serial:
-                    continue
+        for name, output_name in sorted(matched.items(), key=lambda i: order[i[0]]):
+            rule = config.monitors[name]
+            placements[output_name] = Placement(
+                position=[rule.x, rule.y],
+                rotation=_ROTATIONS[rule.rotation],
+                # output of first rule is the primary one
+                primary=not placements,
+            )
 
-                placements[m.output] = Placement(
-                    rotation=cm["rotation"],
-                    primary=cm["primary"],
-                    position=[int(cm["position"]["x"]), int(cm["position"]["y"])]
-                )
-                break
+        side = next((r.placement for r in config.monitors.values() if isinstance(r, DynamicMonitorConfig)), None)
+        dynamic = tuple((n, side) for n in sorted(unmatched)) if side else ()
 
-        self.dl.placements = placements
-        await self.lm.apply(monitor)
+        return placements, dynamic
 
+    async def do(self, config: ActiveConfig, monitors, context, **kwargs):
+        self.dl.placements, self.dl.dynamic = self.get_placements(config, monitors, context)
+        await self.lm.apply(monitors)
 
-class CommandAction(object):
-    async def do(self, args, **kwargs):
-        await asyncio.create_subprocess_exec(*args)
 
+class FilesAction(object):
+    def __init__(self, renderer: FileRenderer):
+        super().__init__()
 
-def from_config(cfg):
-    wm = WallpaperManager(cfg["wallpaper"]["directory"])
-    lm = LayoutManager()
-    dl = DynamicLayout()
+        self.renderer = renderer
 
-    dinfo = DetectionInfo()
-    events = {
-        "screen": ScreenHint,
-        "wifi": WifiHint,
-        "host": HostHint,
-        "monitor": MonitorHint
-    }
+    async def do(self, config: ActiveConfig, context, **kwargs):
+        # only files with changed inputs are rendered again
+        await self.renderer.apply(config.files, context)
 
-    actions = {
-        "wallpaper": WallpaperAction(wm),
-        "layout": LayoutAction(lm, dl),
-        "command": CommandAction()
-    }
-    lm.add_layout(dl)
 
-    for action in cfg["actions"]:
-        mapped_events = tuple(map(events.get, action["events"]))
-        dinfo.add_listener(
-            mapped_events,
-            ActionCallback(action["if"], action["do"], action["watch"], action["events"], actions))
+class CommandAction(object):
+    def __init__(self, dispatcher: CommandDispatcher):
+        super().__init__()
+
+        self.dispatcher = dispatcher
+
+    async def do(self, config: ActiveConfig, name, context, **kwargs):
+        await self.dispatcher.run_config(name, config.commands[name], **context)
 
-    dinfo.start()
 
-    dimmer = Dimmer()
+class Customizer(object):
+    """
+    Runs actions of matched places for detection events.
 
-    dimmer.connect()
-    lm.connect()
+    Reloaded config is applied to last detection state, running only actions affected by its changes.
+    """
 
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(asyncio.gather(dinfo.watch(), dimmer.loop()))
+    def __init__(
+            self,
+            config: MainConfig,
+            x_connection: XConnection,
+            wallpaper_index_path: typing.Optional[pathlib.Path] = None
+    ):
+        super().__init__()
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.dispatcher = CommandDispatcher()
+        self.files = FileRenderer(self.dispatcher)
+        self.lm = LayoutManager(x_connection=x_connection)
+        self.dl = DynamicLayout()
+        self.lm.add_layout(self.dl)
+
+        self.wallpaper = WallpaperAction(wallpaper_index_path)
+        self.scheduler = ActionScheduler({
+            "layout": LayoutAction(self.lm, self.dl),
+            "wallpaper": self.wallpaper,
+            "files": FilesAction(self.files),
+            "command": CommandAction(self.dispatcher),
+        })
+
+        self.places = PlaceMatcher(config)
+        self._active: typing.Optional[ActiveConfig] = None
+        self._state = None
+        # events and reloads would otherwise run same actions concurrently
+        self._lock = asyncio.Lock()
+
+    def connect(self):
+        self.lm.connect()
+
+    async def disconnect(self):
+        await self.wallpaper.close()
+        self.files.shutdown()
+        self.lm.disconnect()
+
+    def _forget_commands(self, old: typing.Optional[ActiveConfig], new: ActiveConfig):
+        # commands are run again when their place is entered again or they were overridden
+        for name, command in (old.commands if old else {}).items():
+            if new.commands.get(name) != command:
+                self.dispatcher.forget(name)
+
+    def get_entries(self, active: ActiveConfig, monitors_changed: bool, screens_changed: bool):
+        entries = []
+        if monitors_changed:
+            entries.append({"layout": {}})
+        if screens_changed:
+            entries.append({"wallpaper": {}})
+        if active.files:
+            entries.append({"files": {}})
+        entries.extend({"command": {"name": name}} for name in active.commands)
+        return entries
+
+    async def _apply(
+            self,
+            monitors_changed: bool,
+            screens_changed: bool,
+            config_diff: typing.Optional[ConfigDiff] = None
+    ):
+        context = get_context(self._state)
+        active = self.places.match(context)
+        context["places"] = active.places
+
+        if config_diff:
+            sections = [config_diff.main] + [
+                config_diff.place_changes[name] for name in active.places if name in config_diff.place_changes
+            ]
+            monitors_changed = monitors_changed or any(s.monitors for s in sections)
+            screens_changed = screens_changed or any(s.wallpaper for s in sections)
+
+        if self._active is None or self._active.places != active.places:
+            self.logger.info("Active places: %s", ", ".join(active.places) or "none")
+            monitors_changed = screens_changed = True
+
+        if active is not self._active:
+            self._forget_commands(self._active, active)
+            self._active = active
+
+        entries = self.get_entries(active, monitors_changed, screens_changed)
+        await self.scheduler.run(entries, {"config": active, "monitors": context["monitors"], "context": context})
+
+    async def handle(self, event: DetectionEvent):
+        diff = event.diff
+        async with self._lock:
+            self._state = event.state
+            await self._apply(
+                monitors_changed=bool(diff.monitors_added or diff.monitors_removed or diff.monitors_changed),
+                screens_changed=bool(diff.screens_changed),
+            )
+
+    async def reload(self, config: MainConfig, diff: ConfigDiff):
+        async with self._lock:
+            self.places = PlaceMatcher(config)
+            # nothing was detected yet, first event uses new config anyway
+            if self._state is None:
+                return
+            await self._apply(monitors_changed=False, screens_changed=False, config_diff=diff)
+
+    async def run(self, detection: DetectionInfo):
+        async for event in detection.watch():
+            try:
+                await self.handle(event)
+            except Exception as e:
+                self.logger.error("Could not handle detection event: %r", e)
+
+    async def watch_config(self, reloader: ConfigReloader, retry_interval=datetime.timedelta(seconds=5)):
+        # failed watch should not stop detection handling, so it is restarted
+        while True:
+            try:
+                async for config, diff in reloader.watch():
+                    try:
+                        await self.reload(config, diff)
+                    except Exception as e:
+                        self.logger.error("Could not apply reloaded config: %r", e)
+            except Exception as e:
+                self.logger.error("Config watch failed, restarting: %r", e)
+            await asyncio.sleep(retry_interval.total_seconds())
+
+
+def get_default_config_path() -> pathlib.Path:
+    base = os.environ.get("XDG_CONFIG_HOME") or pathlib.Path("~/.config").expanduser()
+    return pathlib.Path(base) / "glorpen-desktop-customizer" / "config.yaml"
+
+
+def from_config(config_path: pathlib.Path):
+    x = XConnection()
+
+    loader = Loader(config_path, get_environment(), cache_path=get_cache_dir("config") / "config.pickle")
+    reloader = ConfigReloader(loader, config_path)
+    customizer = Customizer(
+        reloader.load(),
+        x_connection=x,
+        wallpaper_index_path=get_cache_dir("wallpapers") / "index.sqlite",
+    )
+    dinfo = DetectionInfo(x_connection=x, edid_cache_path=get_cache_dir("edid") / "edids.pickle")
+    dimmer = Dimmer(x_connection=x)
+
+    async def run():
+        dinfo.start()
+        dimmer.connect()
+        customizer.connect()
+        try:
+            # detection state and X connection are kept when config is reloaded
+            await asyncio.gather(customizer.run(dinfo), customizer.watch_config(reloader), dimmer.loop())
+        finally:
+            await customizer.disconnect()
+            await dimmer.disconnect()
+            dinfo.stop()
+
+    asyncio.run(run())
 
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.DEBUG)
 
-    config = config_reader("/mnt/sandbox/workspace/glorpen/desktop-customizer/config.yaml")
-    from_config(config)
-    # print(config)
+    from_config(pathlib.Path(sys.argv[1]) if len(sys.argv) > 1 else get_default_config_path())
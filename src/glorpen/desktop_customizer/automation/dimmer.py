@@ -1,168 +1,302 @@
+import array
 import asyncio
+import itertools
 import logging
-import os
+import operator
 import struct
+import typing
+from datetime import timedelta
 
 import xcffib
 import xcffib.randr
 import xcffib.xproto
 
-from glorpen.desktop_customizer.whereami.xrand import get_atom_id
+from glorpen.desktop_customizer.whereami.xrand import query_randr_state
+from glorpen.desktop_customizer.xserver import XConnection
 
 
-# def get_atom_id(con, name):
-#     return con.core.InternAtom(False, len(name), name).reply().atom
-
 class Dimmer(object):
     running = False
 
     _known_fullscreen_window = None
 
-    def __init__(self):
+    def __init__(
+            self,
+            level: float = 0.1,
+            fade_steps: int = 0,
+            fade_duration: timedelta = timedelta(milliseconds=300),
+            x_connection: typing.Optional[XConnection] = None,
+    ):
         super().__init__()
         self.logger = logging.getLogger(self.__class__.__name__)
 
+        self._x = x_connection or XConnection()
+
+        self.level = level
+        self.fade_steps = fade_steps
+        self.fade_duration = fade_duration
+
         self._original_gamma = {}
+        self._dimmed = set()
+        # (crtc, gamma size, level) -> precomputed red, green, blue ramps
+        self._ramps = {}
+        self._gamma_sources = {}
+        # crtc -> index of currently shown fade frame
+        self._gamma_index = {}
+        self._fades = {}
+        # crtc -> (x, y, width, height) of enabled crtcs, kept current by CrtcChange events
+        self._crtc_rects = {}
+        # window -> atoms from its _NET_WM_STATE
+        self._windows = {}
+        self._use_client_list = False
 
     def connect(self):
         self.running = True
-        self.conn = xcffib.connect(os.environ.get("DISPLAY"))
-        self.ext_r = self.conn(xcffib.randr.key)
-
-        self._ATOM_NET_WM_STATE = get_atom_id(self.conn, "_NET_WM_STATE")
-        self._ATOM_FULLSCREEN = get_atom_id(self.conn, "_NET_WM_STATE_FULLSCREEN")
-        self._ATOM_FOCUSED = get_atom_id(self.conn, "_NET_WM_STATE_FOCUSED")
-        self._ATOM_WM_STATE = get_atom_id(self.conn, "WM_STATE")
-
-        self.root = self.conn.get_setup().roots[0].root
-
-    def disconnect(self):
+        self._x.connect()
+        self.conn = self._x.conn
+        self.ext_r = self._x.randr
+
+        (
+            self._ATOM_NET_WM_STATE,
+            self._ATOM_FULLSCREEN,
+            self._ATOM_FOCUSED,
+            self._ATOM_NET_CLIENT_LIST,
+        ) = self._x.get_atom_ids(
+            "_NET_WM_STATE",
+            "_NET_WM_STATE_FULLSCREEN",
+            "_NET_WM_STATE_FOCUSED",
+            "_NET_CLIENT_LIST",
+        )
+
+        self.root = self._x.root
+
+    async def disconnect(self):
         self.running = False
-        self.conn.disconnect()
 
-    def _dim_crtc(self, crtc):
-        if crtc in self._original_gamma:
-            return
+        fades = list(self._fades.values())
+        for task in fades:
+            task.cancel()
+        # fades send requests, so connection is closed only after they stop
+        await asyncio.gather(*fades, return_exceptions=True)
+
+        self._x.disconnect()
 
+    def _fetch_original_gamma(self, crtc):
         org_gamma = self.ext_r.GetCrtcGamma(crtc).reply()
-        self._original_gamma[crtc] = [
-            org_gamma.size,
-            org_gamma.red, org_gamma.green, org_gamma.blue
+        channels = tuple(array.array("H", c) for c in (org_gamma.red, org_gamma.green, org_gamma.blue))
+
+        # user could change gamma (eg. by redshift) since ramps were cached
+        if self._gamma_sources.get(crtc) != channels:
+            self._gamma_sources[crtc] = channels
+            for key in [k for k in self._ramps if k[0] == crtc]:
+                del self._ramps[key]
+
+        self._original_gamma[crtc] = [org_gamma.size, *channels]
+
+    def _get_ramp(self, crtc, level):
+        size, red, green, blue = self._original_gamma[crtc]
+        key = (crtc, size, level)
+        if key not in self._ramps:
+            # whole channel is scaled by C level map, without Python loop over its values
+            self._ramps[key] = tuple(
+                array.array("H", map(int, map(operator.mul, c, itertools.repeat(level)))) for c in (red, green, blue)
+            )
+        return self._ramps[key]
+
+    def _get_frames(self, crtc):
+        """Returns gamma ramps from original one (first) to fully dimmed (last)."""
+        size, red, green, blue = self._original_gamma[crtc]
+        steps = self.fade_steps + 1
+        return [(red, green, blue)] + [
+            self._get_ramp(crtc, round(1 - (1 - self.level) * i / steps, 4)) for i in range(1, steps + 1)
         ]
-        colors = []
-
-        for i in [org_gamma.red, org_gamma.green, org_gamma.blue]:
-            tmp = []
-            for j in i:
-                tmp.append(int(j * 0.1))
-            colors.append(tmp)
 
+    def _show_frame(self, crtc, frames, index):
         # 'size', 'red', 'green', 'blue
+        self.ext_r.SetCrtcGamma(crtc, self._original_gamma[crtc][0], *frames[index])
+        self._gamma_index[crtc] = index
+
+        if index == 0:
+            # original gamma is restored
+            del self._original_gamma[crtc]
+            del self._gamma_index[crtc]
 
-        self.ext_r.SetCrtcGamma(crtc, org_gamma.size, *colors)
+    async def _play_fade(self, crtc, frames, target):
+        delay = self.fade_duration.total_seconds() / (len(frames) - 1)
+        current = self._gamma_index.get(crtc, 0)
+        step = 1 if target > current else -1
+
+        try:
+            for index in range(current + step, target + step, step):
+                self._show_frame(crtc, frames, index)
+                self._x.flush()
+                if index != target:
+                    await asyncio.sleep(delay)
+        finally:
+            if self._fades.get(crtc) is asyncio.current_task():
+                del self._fades[crtc]
+
+    def _fade_to(self, crtc, target):
+        task = self._fades.pop(crtc, None)
+        if task:
+            task.cancel()
+
+        frames = self._get_frames(crtc)
+        target = target % len(frames)
+
+        if self.fade_steps:
+            self._fades[crtc] = asyncio.ensure_future(self._play_fade(crtc, frames, target))
+        elif self._gamma_index.get(crtc, 0) != target:
+            self._show_frame(crtc, frames, target)
+
+    def _dim_crtc(self, crtc):
+        if crtc in self._dimmed:
+            return
+
+        self._dimmed.add(crtc)
+        # when undimming is still in progress current gamma is not the original one
+        if crtc not in self._original_gamma:
+            self._fetch_original_gamma(crtc)
+
+        self._fade_to(crtc, -1)
         # print("dim crtc")
 
     def _undim_crtc(self, crtc):
-        if crtc not in self._original_gamma:
+        if crtc not in self._dimmed:
             return
 
-        self.ext_r.SetCrtcGamma(crtc, *self._original_gamma.pop(crtc))
+        self._dimmed.discard(crtc)
+        self._fade_to(crtc, 0)
 
     def _undim_all(self):
-        for crtc in list(self._original_gamma.keys()):
+        for crtc in list(self._dimmed):
             self._undim_crtc(crtc)
 
+    def _load_crtc_rects(self):
+        window_resources = self.ext_r.GetScreenResources(self.root).reply()
+        crtc_infos = query_randr_state(self.ext_r, crtcs=window_resources.crtcs).crtcs
+
+        self._crtc_rects.clear()
+        for crtc, crtc_info in crtc_infos.items():
+            # skip disabled crtcs
+            if crtc_info.mode == 0:
+                continue
+            self._crtc_rects[crtc] = (crtc_info.x, crtc_info.y, crtc_info.width, crtc_info.height)
+
+    def _update_crtc_rect(self, cc):
+        if cc.mode == 0:
+            self._crtc_rects.pop(cc.crtc, None)
+            return
+
+        # event carries mode size, crtc info reports already rotated one
+        if cc.rotation & (xcffib.randr.Rotation.Rotate_90 | xcffib.randr.Rotation.Rotate_270):
+            self._crtc_rects[cc.crtc] = (cc.x, cc.y, cc.height, cc.width)
+        else:
+            self._crtc_rects[cc.crtc] = (cc.x, cc.y, cc.width, cc.height)
+
     def dim_others(self, used_window):
-        geo = self.conn.core.GetGeometry(used_window).reply()
-        coords = self.conn.core.TranslateCoordinates(used_window, self.root, geo.x, geo.y).reply()
+        coords = self.conn.core.TranslateCoordinates(used_window, self.root, 0, 0).reply()
 
         x = coords.dst_x
         y = coords.dst_y
 
-        window_resources = self.ext_r.GetScreenResources(self.root).reply()
-
-        for output in window_resources.outputs:
-            output_info = self.ext_r.GetOutputInfo(output, 0).reply()
-            if output_info.crtc == 0:
-                continue
-            crtc_info = self.ext_r.GetCrtcInfo(output_info.crtc, 0).reply()
-            # ret.rotation = crtc_info.rotation
-            # print([crtc_info.x, crtc_info.y], [crtc_info.width, crtc_info.height])
-
-            if crtc_info.x <= x < crtc_info.x + crtc_info.width and crtc_info.y <= y < crtc_info.y + crtc_info.height:
-                self._undim_crtc(output_info.crtc)
+        for crtc, (cx, cy, cw, ch) in self._crtc_rects.items():
+            if cx <= x < cx + cw and cy <= y < cy + ch:
+                self._undim_crtc(crtc)
             else:
-                self._dim_crtc(output_info.crtc)
+                self._dim_crtc(crtc)
                 # gamma_size = self.ext_r.GetCrtcGammaSize(output_info.crtc).reply().size
 
             # https://gitlab.freedesktop.org/xorg/app/xrandr/blob/master/xrandr.c#L1511
             # XRRSetCrtcGamma(dpy, crtc->crtc.xid, crtc_gamma);
 
     def get_fullscreen_window(self):
-        return self._find_fullscreen(self.root)
-
-    def _find_fullscreen(self, window):
-        r = self.conn.core.QueryTree(window).reply()
-
-        for w in r.children:
-            d = self.conn.core.GetProperty(
-                window=w, delete=False, type=xcffib.xproto.Atom.ATOM,
-                property=self._ATOM_NET_WM_STATE, long_offset=0, long_length=4).reply()
-            if d.length:
-                z = b"".join(d.value)
-                atoms = struct.unpack("I" * int(len(z) / 4), z)
-                if {self._ATOM_FULLSCREEN, self._ATOM_FOCUSED}.issubset(atoms):
-                    return w
-
-            ret = self._find_fullscreen(w)
-            if ret:
-                return ret
+        for window in self._windows:
+            if self.is_fullscreen(window):
+                return window
 
     def is_fullscreen(self, window):
-        try:
-            d = self.conn.core.GetProperty(
-                window=window, delete=False, type=xcffib.xproto.Atom.ATOM,
-                property=self._ATOM_NET_WM_STATE, long_offset=0, long_length=4).reply()
-        except xcffib.xproto.WindowError:
-            return False
-
-        if d.length:
-            z = b"".join(d.value)
-            atoms = struct.unpack("I" * int(len(z) / 4), z)
-            return {self._ATOM_FULLSCREEN, self._ATOM_FOCUSED}.issubset(atoms)
-        return False
-
-    def _walk_windows(self, window, cb):
-        try:
-            r = self.conn.core.QueryTree(window).reply()
-        except xcffib.xproto.WindowError:
-            return
-
-        d = self.conn.core.GetProperty(
-            window=window, delete=False, type=xcffib.xproto.Atom.Any,
-            property=self._ATOM_WM_STATE, long_offset=0, long_length=4).reply()
-        # skip windows without WM_STATE property
-        if not d.value:
-            return
+        return {self._ATOM_FULLSCREEN, self._ATOM_FOCUSED}.issubset(self._windows.get(window, ()))
+
+    def _get_property_cookie(self, window, prop, type_):
+        return self.conn.core.GetProperty(
+            window=window, delete=False, type=type_,
+            property=prop, long_offset=0, long_length=1024)
+
+    @classmethod
+    def _unpack_ids(cls, reply):
+        if not reply.length:
+            return ()
+        z = b"".join(reply.value)
+        return struct.unpack("I" * int(len(z) / 4), z)
+
+    def _select_events(self, window):
+        self.conn.core.ChangeWindowAttributes(
+            window,
+            value_mask=xcffib.xproto.CW.EventMask,
+            value_list=[
+                xcffib.xproto.EventMask.PropertyChange | xcffib.xproto.EventMask.SubstructureNotify | xcffib.xproto.EventMask.StructureNotify
+            ]
+        )
+
+    def _track_windows(self, windows):
+        """Registers windows with their current _NET_WM_STATE, all states are fetched in single round trip."""
+        cookies = {}
+        for w in windows:
+            self._select_events(w)
+            cookies[w] = self._get_property_cookie(w, self._ATOM_NET_WM_STATE, xcffib.xproto.Atom.ATOM)
+
+        for w, cookie in cookies.items():
+            try:
+                self._windows[w] = frozenset(self._unpack_ids(cookie.reply()))
+            except xcffib.xproto.WindowError:
+                # window is already gone
+                self._windows.pop(w, None)
+
+    def _update_window_state(self, window):
+        if window in self._windows:
+            self._track_windows([window])
+
+    def _get_client_list(self):
+        reply = self._get_property_cookie(self.root, self._ATOM_NET_CLIENT_LIST, xcffib.xproto.Atom.WINDOW).reply()
+        if reply.format == 0:
+            # property is not set, WM does not support EWMH
+            return None
+        return self._unpack_ids(reply)
+
+    def _sync_client_list(self):
+        clients = self._get_client_list() or ()
+
+        for w in set(self._windows).difference(clients):
+            del self._windows[w]
+
+        self._track_windows([w for w in clients if w not in self._windows])
+
+    def _walk_windows(self):
+        """Breadth-first walk with all QueryTree requests for a tree level sent at once."""
+        level = [self.root]
+        while level:
+            cookies = [self.conn.core.QueryTree(w) for w in level]
+            level = []
+            for cookie in cookies:
+                try:
+                    level.extend(cookie.reply().children)
+                except xcffib.xproto.WindowError:
+                    pass
+            yield level
 
-        for w in r.children:
-            yield cb(w)
-            self._walk_windows(w, cb)
-
-    def _setup_events(self, window):
-        def set_events(win):
-            self.conn.core.ChangeWindowAttributes(
-                win,
-                value_mask=xcffib.xproto.CW.EventMask,
-                value_list=[
-                    xcffib.xproto.EventMask.PropertyChange | xcffib.xproto.EventMask.SubstructureNotify | xcffib.xproto.EventMask.StructureNotify
-                ]
-            )
+    def _build_registry(self):
+        self._windows.clear()
+        self._select_events(self.root)
 
-        set_events(window)
+        clients = self._get_client_list()
+        self._use_client_list = clients is not None
 
-        for dummy in self._walk_windows(window, set_events):
-            pass
+        if self._use_client_list:
+            self._track_windows(clients)
+        else:
+            for windows in self._walk_windows():
+                self._track_windows(windows)
 
     def handle_window(self, window):
         if self.is_fullscreen(window):
@@ -179,36 +313,54 @@ class Dimmer(object):
                 # we are not fs window, so check if last fs win is still fs
                 self._undim_all()
 
+    def handle_event(self, ev):
+        if isinstance(ev, xcffib.randr.NotifyEvent):
+            if ev.subCode == xcffib.randr.Notify.CrtcChange:
+                self.logger.debug("CrtcChange: crtc %d", ev.u.cc.crtc)
+                self._update_crtc_rect(ev.u.cc)
+                if self._known_fullscreen_window:
+                    self.handle_window(self._known_fullscreen_window)
+        elif isinstance(ev, xcffib.xproto.PropertyNotifyEvent):
+            self.logger.debug("Property:  window %d", ev.window)
+            if ev.window == self.root:
+                if ev.atom == self._ATOM_NET_CLIENT_LIST and self._use_client_list:
+                    self._sync_client_list()
+            elif ev.atom == self._ATOM_NET_WM_STATE:
+                self._update_window_state(ev.window)
+                self.handle_window(ev.window)
+        elif isinstance(ev, xcffib.xproto.MapNotifyEvent):
+            self.logger.debug("MapNotify: window %d", ev.window)
+            self.handle_window(ev.window)
+        elif isinstance(ev, xcffib.xproto.ConfigureNotifyEvent):
+            self.logger.debug("Configure: window %d", ev.window)
+            self.handle_window(ev.window)
+        elif isinstance(ev, xcffib.xproto.DestroyNotifyEvent):
+            self.logger.debug("DestroyNotify: window %d", ev.window)
+            self._windows.pop(ev.window, None)
+            self.handle_window(ev.window)
+        elif isinstance(ev, xcffib.xproto.CreateNotifyEvent):
+            self.logger.debug("CreateNotify: window %d", ev.window)
+            if not self._use_client_list:
+                self._track_windows([ev.window])
+        elif isinstance(ev, xcffib.xproto.ReparentNotifyEvent):
+            self.logger.debug("ReparentNotify: window %d", ev.window)
+            if not self._use_client_list and ev.window not in self._windows:
+                self._track_windows([ev.window])
+        else:
+            self.logger.debug("Unhandled event %r", ev)
+
     async def loop(self):
         # return
-        self._setup_events(self.root)
+        events = self._x.subscribe()
 
-        while self.running:
-            while True:
-                try:
-                    ev = self.conn.poll_for_event()
-                except xcffib.xproto.WindowError as e:
-                    break
-
-                if ev is None:
-                    break
-
-                if isinstance(ev, xcffib.xproto.PropertyNotifyEvent):
-                    self.logger.debug("Property:  window %d", ev.window)
-                    self.handle_window(ev.window)
-                elif isinstance(ev, xcffib.xproto.MapNotifyEvent):
-                    self.logger.debug("MapNotify: window %d", ev.window)
-                    self.handle_window(ev.window)
-                elif isinstance(ev, xcffib.xproto.ConfigureNotifyEvent):
-                    self.logger.debug("Configure: window %d", ev.window)
-                    self.handle_window(ev.window)
-                elif isinstance(ev, xcffib.xproto.DestroyNotifyEvent):
-                    self.logger.debug("Configure: window %d", ev.window)
-                    self.handle_window(ev.window)
-                elif isinstance(ev, xcffib.xproto.CreateNotifyEvent):
-                    self.logger.debug("CreateNotify: window %d", ev.window)
-                    self._setup_events(ev.window)
-                else:
-                    self.logger.debug("Unhandled event %r", ev)
-
-            await asyncio.sleep(0.2)
+        try:
+            self._load_crtc_rects()
+            self._x.select_randr_input(xcffib.randr.NotifyMask.CrtcChange)
+            self._build_registry()
+            self._x.flush()
+
+            while self.running:
+                self.handle_event(await events.get())
+                self._x.flush()
+        finally:
+            self._x.unsubscribe(events)
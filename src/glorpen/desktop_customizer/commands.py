@@ -0,0 +1,209 @@
+import asyncio
+import collections
+import dataclasses
+import datetime
+import logging
+import time
+import typing
+
+from glorpen.desktop_customizer.config.model import CommandConfig
+
+# shell command or program with its arguments
+Command = typing.Union[str, typing.Sequence[str]]
+
+
+@dataclasses.dataclass(frozen=True)
+class CommandResult:
+    command: Command
+    # None when command was still running after timeout or was superseded before starting
+    returncode: typing.Optional[int]
+    duration: float
+    superseded: bool = False
+
+
+class _Run(object):
+    def __init__(self):
+        super().__init__()
+        self.superseded = asyncio.Event()
+
+
+class CommandDispatcher(object):
+    """
+    Runs commands with coalescing and a limit of running processes.
+
+    Identical commands requested within ``window`` are run once, and a new run of a command stops its previous,
+    still running one. Stopped command is killed when it is still running after ``grace_period``.
+    """
+
+    def __init__(
+            self,
+            window: datetime.timedelta = datetime.timedelta(milliseconds=300),
+            concurrency: int = 2,
+            timeout: typing.Optional[datetime.timedelta] = datetime.timedelta(seconds=30),
+            grace_period: datetime.timedelta = datetime.timedelta(seconds=5),
+            history_size: int = 100
+    ):
+        super().__init__()
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.window = window
+        self.timeout = timeout
+        self.grace_period = grace_period
+        self.history: typing.Deque[CommandResult] = collections.deque(maxlen=history_size)
+
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._pending: typing.Dict[typing.Hashable, asyncio.Future] = {}
+        self._running: typing.Dict[typing.Hashable, _Run] = {}
+        self._fingerprints: typing.Dict[str, bytes] = {}
+        self._reapers = set()
+
+        # configured commands run and skipped by run_config
+        self.executed = 0
+        self.skipped = 0
+
+    @classmethod
+    def _get_key(cls, command: Command) -> typing.Hashable:
+        return command if isinstance(command, str) else tuple(command)
+
+    async def run(self, command: Command, timeout: typing.Optional[datetime.timedelta] = None) -> CommandResult:
+        """Schedules command, or joins already scheduled identical one."""
+        key = self._get_key(command)
+        fut = self._pending.get(key)
+        if fut is None:
+            fut = self._pending[key] = asyncio.ensure_future(self._schedule(key, command, timeout or self.timeout))
+        # other callers wait for same run
+        return await asyncio.shield(fut)
+
+    async def run_config(self, name: str, config: CommandConfig, **context) -> typing.Optional[CommandResult]:
+        """
+        Runs configured command when values it watches have changed, returns None when skipped.
+
+        Command without watched values is run once, until it is forgotten.
+        """
+        fingerprint = config.get_fingerprint(**context) if config.watch else None
+        if name in self._fingerprints and self._fingerprints[name] == fingerprint:
+            self.skipped += 1
+            return None
+
+        self.executed += 1
+        result = await self.run(config.run)
+        # command still running after timeout has started fine
+        if result.returncode == 0 or (result.returncode is None and not result.superseded):
+            self._fingerprints[name] = fingerprint
+        else:
+            self._fingerprints.pop(name, None)
+        return result
+
+    def forget(self, name: str):
+        """Makes next :meth:`run_config` call run given command regardless of its watched values."""
+        self._fingerprints.pop(name, None)
+
+    async def _schedule(self, key, command: Command, timeout: typing.Optional[datetime.timedelta]) -> CommandResult:
+        try:
+            await asyncio.sleep(self.window.total_seconds())
+        finally:
+            # requests from now on start another run
+            del self._pending[key]
+
+        previous = self._running.get(key)
+        if previous:
+            previous.superseded.set()
+        run = self._running[key] = _Run()
+
+        result = None
+        try:
+            async with self._semaphore:
+                result = await self._execute(key, command, run, timeout)
+        finally:
+            # command left running is unregistered by its reaper, so it can still be superseded
+            detached = result is not None and result.returncode is None and not result.superseded
+            if not detached and self._running.get(key) is run:
+                del self._running[key]
+
+        self.history.append(result)
+        if result.returncode and not result.superseded:
+            self.logger.warning("Command %r exited with %d after %.2fs", command, result.returncode, result.duration)
+        else:
+            self.logger.debug("Command %r finished in %.2fs: %r", command, result.duration, result)
+
+        return result
+
+    async def _reap(self, command: Command, proc, start: float):
+        returncode = await proc.wait()
+        self.history.append(CommandResult(command, returncode, time.monotonic() - start))
+
+    async def _reap_running(self, key, command: Command, proc, waiter: asyncio.Future, run: _Run, start: float):
+        try:
+            superseded = asyncio.ensure_future(run.superseded.wait())
+            try:
+                await asyncio.wait([waiter, superseded], return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                superseded.cancel()
+
+            if waiter.done():
+                returncode = waiter.result()
+            else:
+                returncode = await self._stop(command, proc, waiter)
+                if returncode is None:
+                    returncode = await proc.wait()
+            self.history.append(
+                CommandResult(command, returncode, time.monotonic() - start, superseded=run.superseded.is_set())
+            )
+        finally:
+            if self._running.get(key) is run:
+                del self._running[key]
+
+    def _start_reaper(self, coro):
+        reaper = asyncio.ensure_future(coro)
+        self._reapers.add(reaper)
+        reaper.add_done_callback(self._reapers.discard)
+
+    async def _stop(self, command: Command, proc, waiter: asyncio.Future) -> typing.Optional[int]:
+        """Terminates superseded command, returns None when it had to be killed."""
+        self.logger.info("Stopping superseded command %r", command)
+        proc.terminate()
+        try:
+            return await asyncio.wait_for(asyncio.shield(waiter), self.grace_period.total_seconds())
+        except asyncio.TimeoutError:
+            self.logger.warning("Command %r did not stop in %s, killing it", command, self.grace_period)
+            proc.kill()
+            return None
+
+    async def _execute(
+            self, key, command: Command, run: _Run, timeout: typing.Optional[datetime.timedelta]
+    ) -> CommandResult:
+        start = time.monotonic()
+        if run.superseded.is_set():
+            return CommandResult(command, None, 0, superseded=True)
+
+        if isinstance(command, str):
+            proc = await asyncio.create_subprocess_shell(command)
+        else:
+            proc = await asyncio.create_subprocess_exec(*command)
+
+        waiter = asyncio.ensure_future(proc.wait())
+        superseded = asyncio.ensure_future(run.superseded.wait())
+        try:
+            await asyncio.wait(
+                [waiter, superseded],
+                timeout=timeout.total_seconds() if timeout else None,
+                return_when=asyncio.FIRST_COMPLETED
+            )
+        finally:
+            superseded.cancel()
+
+        if waiter.done():
+            return CommandResult(command, waiter.result(), time.monotonic() - start)
+
+        if run.superseded.is_set():
+            returncode = await self._stop(command, proc, waiter)
+            if returncode is None:
+                # killed process is collected without holding a slot for other commands
+                self._start_reaper(self._reap(command, proc, start))
+            return CommandResult(command, returncode, time.monotonic() - start, superseded=True)
+
+        # long running commands (eg. daemons) are left alone, but still collected when they exit
+        # or stopped when superseded
+        self.logger.warning("Command %r is still running after %s, not waiting for it", command, timeout)
+        self._start_reaper(self._reap_running(key, command, proc, waiter, run, start))
+        return CommandResult(command, None, time.monotonic() - start)
@@ -1,11 +1,19 @@
 import collections.abc
+import hashlib
+import logging
 import pathlib
+import pickle
 import types
 import typing
 from dataclasses import dataclass, field, fields, is_dataclass, MISSING, Field
 
+import yaml
 from jinja2.environment import TemplateExpression, Template, Environment
 
+from glorpen.desktop_customizer.config.selectors import Selector
+from glorpen.desktop_customizer.config.templating import compile_expression, compile_template, get_compiled_cache, \
+    watch_fingerprint
+
 
 class UserPath(pathlib.Path):
     pass
@@ -38,14 +46,21 @@ class CommandConfig:
     run: str
     watch: typing.Sequence[TemplateExpression]
 
+    def get_fingerprint(self, **context) -> bytes:
+        return watch_fingerprint(self.watch, context)
+
 
 @dataclass(kw_only=True)
 class MonitorConfig:
     x: int
     y: int
-    selector: TemplateExpression
+    selector: Selector
     rotation: int = field(default=0)
 
+    def validate(self):
+        if self.rotation not in (0, 90, 180, 270):
+            raise ValueError("rotation has to be one of: 0, 90, 180, 270")
+
 
 @dataclass(kw_only=True)
 class DynamicMonitorConfig:
@@ -63,7 +78,7 @@ class NestedConfig:
 
 @dataclass(kw_only=True)
 class PlaceConfig(NestedConfig):
-    selector: TemplateExpression
+    selector: Selector
 
 
 @dataclass(kw_only=True)
@@ -71,100 +86,200 @@ class MainConfig(NestedConfig):
     places: typing.Dict[str, PlaceConfig]
 
 
+_Converter = typing.Callable[["Loader", typing.Any, typing.Any, str], typing.Any]
+
+
 class Loader:
     """
     Custom simple typehint/dataclass filler & validator.
 
     Pydantic does not have nice third party types registration and does not support validation context,
     Marshmallow has own classes and environment.
+
+    Each dataclass and typehint is compiled once into a converter function, converters are shared between loaders.
     """
 
-    def __init__(self, config_path: pathlib.Path, env: Environment):
+    _converters: typing.ClassVar[typing.Dict[typing.Any, _Converter]] = {}
+
+    _custom_types: typing.ClassVar[typing.Dict[typing.Any, typing.Callable[["Loader", typing.Any], typing.Any]]] = {
+        pathlib.Path: lambda loader, data: pathlib.Path(data),
+        bool: lambda loader, data: bool(data),
+        str: lambda loader, data: str(data),
+        int: lambda loader, data: int(data),
+        Template: lambda loader, data: loader._compile_source(Template, data),
+        TemplateExpression: lambda loader, data: loader._compile_source(TemplateExpression, data),
+        Selector: lambda loader, data: loader._compile_source(Selector, data),
+        ExistingUserPath: lambda loader, data: (
+            loader._config_path.parent / pathlib.Path(data).expanduser()
+        ).resolve(strict=True),
+        UserPath: lambda loader, data: (loader._config_path.parent / pathlib.Path(data).expanduser()).resolve(),
+    }
+
+    def __init__(self, config_path: pathlib.Path, env: Environment, cache_path: typing.Optional[pathlib.Path] = None):
+        self.logger = logging.getLogger(self.__class__.__name__)
         self._config_path = config_path
         self._env = env
-
-    def _try_each_hint(self, data, types, path: str):
-        e = []
-        for maybe_type in types:
-            try:
-                return self._get_any(data, maybe_type, MISSING, path)
-            except Exception as ee:
-                e.append(f"    - {maybe_type.__name__}: {ee}")
-
-        raise ValueError(f"""{path}: Could not convert to any of:\n""" + "\n".join(e))
-
-    def _get_custom_type(self, data, type_):
-        if type_ is pathlib.Path:
-            return pathlib.Path(data)
-
-        if type_ is bool:
-            return bool(data)
-        if type_ is str:
-            return str(data)
-        if type_ is int:
-            return int(data)
+        self._cache_path = cache_path
+        # (mtime & size, content digest, config) of last loaded file
+        self._loaded: typing.Optional[typing.Tuple[typing.Tuple[int, int], str, MainConfig]] = None
+        # templates compiled by current and previous load, reusing them makes unchanged parts of reloaded config equal
+        self._compiled: typing.Dict[typing.Tuple[type, str], typing.Any] = {}
+        self._previous_compiled: typing.Dict[typing.Tuple[type, str], typing.Any] = {}
+
+    def _compile_new_source(self, type_, source: str):
         if type_ is Template:
-            return self._env.from_string(data)
-        if type_ is TemplateExpression:
-            return self._env.compile_expression(data)
-        if type_ is ExistingUserPath:
-            return (self._config_path.parent / pathlib.Path(data).expanduser()).resolve(strict=True)
-        if type_ is UserPath:
-            return (self._config_path.parent / pathlib.Path(data).expanduser()).resolve()
-
-    def _get_typehint(self, data, type_, default, path):
+            return compile_template(self._env, source)
+        if type_ is Selector:
+            return Selector.compile(self._env, source)
+        return compile_expression(self._env, source)
+
+    def _compile_source(self, type_, source: str):
+        key = (type_, source)
+        ret = self._compiled.get(key) or self._previous_compiled.get(key)
+        if ret is None:
+            ret = get_compiled_cache(self._env).get(key, lambda: self._compile_new_source(type_, source))
+        self._compiled[key] = ret
+        return ret
+
+    @classmethod
+    def _get_converter(cls, type_) -> _Converter:
+        converter = cls._converters.get(type_)
+        if converter is None:
+            # placeholder for self-referencing types, resolves to compiled converter when called
+            cls._converters[type_] = lambda loader, data, default, path: cls._converters[type_](
+                loader, data, default, path
+            )
+            converter = cls._converters[type_] = cls._compile(type_)
+        return converter
+
+    @classmethod
+    def _compile(cls, type_) -> _Converter:
+        if is_dataclass(type_):
+            return cls._compile_model(type_)
+
         origin = typing.get_origin(type_)
 
         if origin is typing.Union:
-            return self._try_each_hint(data, typing.get_args(type_), path)
-
-        if data is not None:
-            if origin is dict:
-                args = typing.get_args(type_)
-                ret = {}
-                for k, v in data.items():
-                    ret[self._get_any(k, args[0], MISSING, f"{path}.{k}:key")] = self._get_any(v, args[1], MISSING,
-                        f"{path}.{k}")
-                return ret
-            if origin is typing.Literal:
-                args = typing.get_args(type_)
-                if data in args:
-                    return data
-                else:
-                    raise ValueError(f"{path}: {data} is not one of {args}")
+            return cls._compile_union(typing.get_args(type_))
+
+        if origin is dict:
+            convert_data = cls._compile_dict(*typing.get_args(type_))
+        elif origin is typing.Literal:
+            convert_data = cls._compile_literal(typing.get_args(type_))
+        elif origin and issubclass(origin, collections.abc.Sequence):
+            convert_data = cls._compile_sequence(typing.get_args(type_)[0])
+        elif type_ in cls._custom_types:
+            convert_data = cls._compile_custom(cls._custom_types[type_])
+        else:
+            def convert_data(loader, data, path):
+                raise NotImplementedError(f"{path}: not supported typehint {type_}")
 
-            if origin and issubclass(origin, collections.abc.Sequence):
-                args = typing.get_args(type_)
-                ret = []
-                for index, i in enumerate(data):
-                    ret.append(self._get_any(i, args[0], MISSING, f"{path}.{index}"))
-                return tuple(ret)
+        is_none_type = type_ is types.NoneType
+
+        def convert(loader, data, default, path):
+            if data is not None:
+                return convert_data(loader, data, path)
+            if default is not MISSING:
+                return default
+            if is_none_type:
+                return None
+            raise ValueError(f"{path} is required")
+
+        return convert
+
+    @classmethod
+    def _compile_union(cls, args) -> _Converter:
+        optional = types.NoneType in args
+        candidates = tuple((t, cls._get_converter(t)) for t in args if t is not types.NoneType)
+
+        def convert(loader, data, default, path):
+            if data is None and optional:
+                return None
+
+            errors = []
+            for maybe_type, converter in candidates:
+                try:
+                    return converter(loader, data, MISSING, path)
+                except Exception as e:
+                    errors.append((maybe_type, e))
+
+            if optional:
+                errors.append((types.NoneType, NotImplementedError(f"{path}: not supported typehint {types.NoneType}")))
+
+            raise ValueError(
+                f"""{path}: Could not convert to any of:\n""" +
+                "\n".join(f"    - {t.__name__}: {e}" for t, e in errors)
+            )
+
+        return convert
+
+    @classmethod
+    def _compile_dict(cls, key_type, value_type):
+        convert_key = cls._get_converter(key_type)
+        convert_value = cls._get_converter(value_type)
 
+        def convert(loader, data, path):
+            ret = {}
+            for k, v in data.items():
+                ret[convert_key(loader, k, MISSING, f"{path}.{k}:key")] = convert_value(
+                    loader, v, MISSING, f"{path}.{k}"
+                )
+            return ret
+
+        return convert
+
+    @classmethod
+    def _compile_literal(cls, args):
+        def convert(loader, data, path):
+            if data in args:
+                return data
+            raise ValueError(f"{path}: {data} is not one of {args}")
+
+        return convert
+
+    @classmethod
+    def _compile_sequence(cls, item_type):
+        convert_item = cls._get_converter(item_type)
+
+        def convert(loader, data, path):
+            return tuple(convert_item(loader, i, MISSING, f"{path}.{index}") for index, i in enumerate(data))
+
+        return convert
+
+    @classmethod
+    def _compile_custom(cls, factory):
+        def convert(loader, data, path):
             try:
-                ret = self._get_custom_type(data, type_)
+                return factory(loader, data)
             except Exception as e:
                 raise ValueError(f"{path}: {e}")
-            if ret is not None:
-                return ret
 
-            raise NotImplementedError(f"{path}: not supported typehint {type_}")
+        return convert
 
-        else:
-            if default is not MISSING:
+    @classmethod
+    def _compile_model(cls, model) -> _Converter:
+        specs = tuple((f.name, f".{f.name}", cls._get_converter(f.type), f) for f in fields(model))
+        validate = hasattr(model, "validate")
+
+        def convert(loader, data, default, path):
+            if data is None and default is not MISSING:
                 return default
 
-            if type_ is types.NoneType:
-                return None
+            kw = {}
+            for name, suffix, converter, f in specs:
+                value = data.get(name, None)
+                # defaults are only used for missing values, so skip building them otherwise
+                kw[name] = converter(loader, value, MISSING if value is not None else cls._get_default(f), path + suffix)
 
-            raise ValueError(f"{path} is required")
+            ret = model(**kw)
+            if validate:
+                try:
+                    ret.validate()
+                except ValueError as e:
+                    raise ValueError(f"{path}: {e}")
+            return ret
 
-    def _get_any(self, data, cls_or_type, default, path: str):
-        if is_dataclass(cls_or_type):
-            if data is None and default is not MISSING:
-                return default
-            return self._get_model(data, cls_or_type, path)
-        else:
-            return self._get_typehint(data, cls_or_type, default, path)
+        return convert
 
     @classmethod
     def _get_default(cls, f: Field):
@@ -174,20 +289,64 @@ class Loader:
             return f.default_factory()
         return MISSING
 
-    def _get_model(self, data, cls, path: str):
-        kw = {}
-        for f in fields(cls):
-            kw[f.name] = self._get_any(data.get(f.name, None), f.type, self._get_default(f), f"{path}.{f.name}")
-        ret = cls(**kw)
-        if hasattr(ret, "validate"):
-            try:
-                ret.validate()
-            except ValueError as e:
-                raise ValueError(f"{path}: {e}")
-        return ret
+    def _get_any(self, data, cls_or_type, default, path: str):
+        return self._get_converter(cls_or_type)(self, data, default, path)
 
     def get_config(self, data: dict) -> MainConfig:
+        self._previous_compiled = self._compiled
+        self._compiled = {}
         try:
-            return self._get_model(data, MainConfig, "")
+            return self._get_any(data, MainConfig, MISSING, "")
         except ValueError as e:
             raise ValueError(e) from None
+
+    def _read_data(self, raw: bytes, digest: str):
+        """Parses YAML, parsed data is persisted in cache file keyed by content digest."""
+        if self._cache_path:
+            try:
+                with self._cache_path.open("rb") as f:
+                    cached_digest, data = pickle.load(f)
+                if cached_digest == digest:
+                    return data
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                self.logger.warning("Could not read config cache %s: %s", self._cache_path, e)
+
+        data = yaml.safe_load(raw)
+
+        if self._cache_path:
+            try:
+                self._cache_path.parent.mkdir(parents=True, exist_ok=True)
+                tmp_path = self._cache_path.with_name(self._cache_path.name + ".tmp")
+                with tmp_path.open("wb") as f:
+                    pickle.dump((digest, data), f)
+                tmp_path.replace(self._cache_path)
+            except OSError as e:
+                self.logger.warning("Could not write config cache %s: %s", self._cache_path, e)
+
+        return data
+
+    def load(self) -> MainConfig:
+        """
+        Reads and validates config file.
+
+        Unchanged file (same mtime and size, or same content) returns previously loaded config.
+        """
+        stat = self._config_path.stat()
+        stamp = (stat.st_mtime_ns, stat.st_size)
+
+        if self._loaded and self._loaded[0] == stamp:
+            return self._loaded[2]
+
+        raw = self._config_path.read_bytes()
+        digest = hashlib.sha256(raw).hexdigest()
+
+        if self._loaded and self._loaded[1] == digest:
+            self._loaded = (stamp, digest, self._loaded[2])
+            return self._loaded[2]
+
+        config = self.get_config(self._read_data(raw, digest))
+        self._loaded = (stamp, digest, config)
+        self.logger.debug("Compiled templates cache hit rate: %.2f", get_compiled_cache(self._env).hit_rate)
+        return config
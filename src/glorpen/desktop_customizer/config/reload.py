@@ -0,0 +1,199 @@
+import asyncio
+import dataclasses
+import datetime
+import logging
+import pathlib
+import typing
+
+import yaml
+
+from glorpen.desktop_customizer.config.model import Loader, MainConfig, NestedConfig, PlaceConfig
+from glorpen.desktop_customizer.inotify import Inotify, IN_Q_OVERFLOW
+
+_Paths = typing.FrozenSet[pathlib.Path]
+
+
+@dataclasses.dataclass(frozen=True)
+class KeysDiff:
+    added: typing.FrozenSet[str] = frozenset()
+    removed: typing.FrozenSet[str] = frozenset()
+    changed: typing.FrozenSet[str] = frozenset()
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.changed)
+
+    @classmethod
+    def compare(cls, old: dict, new: dict, is_changed=None):
+        is_changed = is_changed or (lambda k: old[k] != new[k])
+        return cls(
+            added=frozenset(new.keys() - old.keys()),
+            removed=frozenset(old.keys() - new.keys()),
+            changed=frozenset(k for k in old.keys() & new.keys() if is_changed(k)),
+        )
+
+
+@dataclasses.dataclass(frozen=True)
+class NestedConfigDiff:
+    monitors: KeysDiff = KeysDiff()
+    files: KeysDiff = KeysDiff()
+    commands: KeysDiff = KeysDiff()
+    wallpaper: bool = False
+    selector: bool = False
+
+    def __bool__(self):
+        return bool(self.monitors or self.files or self.commands or self.wallpaper or self.selector)
+
+
+@dataclasses.dataclass(frozen=True)
+class ConfigDiff:
+    main: NestedConfigDiff = NestedConfigDiff()
+    places: KeysDiff = KeysDiff()
+    place_changes: typing.Mapping[str, NestedConfigDiff] = dataclasses.field(default_factory=dict)
+
+    def __bool__(self):
+        return bool(self.main or self.places)
+
+
+def get_sources(config: NestedConfig) -> _Paths:
+    """Returns existing paths config depends on, including ones from places."""
+    sources = set(f.src for f in config.files.values() if f.src)
+    # wallpaper defaults to empty dict
+    wallpaper_dir = getattr(config.wallpaper, "dir", None)
+    if wallpaper_dir:
+        sources.add(wallpaper_dir)
+
+    if isinstance(config, MainConfig):
+        for place in config.places.values():
+            sources.update(get_sources(place))
+
+    return frozenset(sources)
+
+
+def _diff_nested(old: NestedConfig, new: NestedConfig, changed_sources: _Paths) -> NestedConfigDiff:
+    return NestedConfigDiff(
+        monitors=KeysDiff.compare(old.monitors, new.monitors),
+        files=KeysDiff.compare(
+            old.files, new.files,
+            lambda k: old.files[k] != new.files[k] or new.files[k].src in changed_sources
+        ),
+        commands=KeysDiff.compare(old.commands, new.commands),
+        wallpaper=old.wallpaper != new.wallpaper or getattr(new.wallpaper, "dir", None) in changed_sources,
+        selector=isinstance(old, PlaceConfig) and old.selector != new.selector,
+    )
+
+
+def diff_configs(old: MainConfig, new: MainConfig, changed_sources: _Paths = frozenset()) -> ConfigDiff:
+    """
+    Compares two configs, section by section.
+
+    Templates and expressions are compared by identity, so both configs should come from the same :class:`Loader`.
+    """
+    place_changes = {}
+    for name in old.places.keys() & new.places.keys():
+        d = _diff_nested(old.places[name], new.places[name], changed_sources)
+        if d:
+            place_changes[name] = d
+
+    return ConfigDiff(
+        main=_diff_nested(old, new, changed_sources),
+        places=KeysDiff(
+            added=frozenset(new.places.keys() - old.places.keys()),
+            removed=frozenset(old.places.keys() - new.places.keys()),
+            changed=frozenset(place_changes.keys()),
+        ),
+        place_changes=place_changes,
+    )
+
+
+class ConfigReloader(object):
+    """
+    Watches config file and paths it references, yields only changed parts of reloaded config.
+
+    Detection state and connections are left to consumers, which should rebuild only things listed in diff.
+    """
+
+    def __init__(self, loader: Loader, config_path: pathlib.Path,
+                 quiet_period: datetime.timedelta = datetime.timedelta(milliseconds=200)):
+        super().__init__()
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self._loader = loader
+        self._config_path = config_path
+        self._quiet_period = quiet_period
+        self._inotify: typing.Optional[Inotify] = None
+
+        self.config: typing.Optional[MainConfig] = None
+
+    def load(self) -> MainConfig:
+        self.config = self._loader.load()
+        return self.config
+
+    def _update_watches(self):
+        self._inotify.remove_all()
+
+        # directories are watched, so files replaced by editors (write & rename) are noticed
+        dirs = {self._config_path.parent}
+        for source in get_sources(self.config):
+            dirs.add(source if source.is_dir() else source.parent)
+
+        for d in dirs:
+            try:
+                self._inotify.add_watch(d)
+            except OSError as e:
+                self.logger.warning("Could not watch %s: %s", d, e)
+
+    async def _collect_changes(self) -> typing.Set[pathlib.Path]:
+        paths = set()
+        events = await self._inotify.wait()
+        # editors usually generate a few events for single save
+        while events:
+            for ev in events:
+                if ev.mask & IN_Q_OVERFLOW:
+                    self.logger.warning("Inotify queue overflow, reloading everything")
+                    paths.add(self._config_path)
+                else:
+                    paths.add(ev.path)
+            try:
+                events = await asyncio.wait_for(self._inotify.wait(), self._quiet_period.total_seconds())
+            except asyncio.TimeoutError:
+                events = None
+        return paths
+
+    async def watch(self) -> typing.AsyncIterator[typing.Tuple[MainConfig, ConfigDiff]]:
+        if self.config is None:
+            self.load()
+
+        self._inotify = Inotify()
+        try:
+            self._update_watches()
+
+            while True:
+                paths = await self._collect_changes()
+                sources = get_sources(self.config)
+
+                changed_sources = frozenset(
+                    s for s in sources if s in paths or (s.is_dir() and any(p.parent == s for p in paths))
+                )
+                if self._config_path not in paths and not changed_sources:
+                    continue
+
+                old = self.config
+                try:
+                    new = self._loader.load()
+                except (ValueError, OSError, yaml.YAMLError, AttributeError, TypeError) as e:
+                    # AttributeError and TypeError come from data of unexpected shape, eg. list instead of mapping
+                    self.logger.error("Could not reload config, keeping current one: %s", e)
+                    continue
+
+                diff = diff_configs(old, new, changed_sources)
+                self.config = new
+
+                if get_sources(new) != sources:
+                    self._update_watches()
+
+                if diff:
+                    self.logger.info("Config was changed")
+                    yield new, diff
+        finally:
+            self._inotify.close()
+            self._inotify = None
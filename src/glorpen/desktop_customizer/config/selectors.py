@@ -0,0 +1,155 @@
+import collections.abc
+import typing
+
+from jinja2 import nodes
+from jinja2.environment import Environment, TemplateExpression
+from jinja2.parser import Parser
+
+from glorpen.desktop_customizer.config.templating import compile_expression
+
+_MISSING = object()
+
+# dotted variable path -> values that satisfy selector
+Constraints = typing.Mapping[str, typing.FrozenSet[typing.Hashable]]
+
+
+def _get_path(node) -> typing.Optional[str]:
+    if isinstance(node, nodes.Name):
+        return node.name
+    if isinstance(node, nodes.Getattr):
+        parent = _get_path(node.node)
+        return f"{parent}.{node.attr}" if parent else None
+    if isinstance(node, nodes.Getitem) and isinstance(node.arg, nodes.Const) and isinstance(node.arg.value, str):
+        parent = _get_path(node.node)
+        return f"{parent}.{node.arg.value}" if parent else None
+    return None
+
+
+def _get_values(node) -> typing.Optional[typing.FrozenSet[typing.Hashable]]:
+    try:
+        if isinstance(node, nodes.Const):
+            return frozenset([node.value])
+        if isinstance(node, (nodes.List, nodes.Tuple)) and all(isinstance(i, nodes.Const) for i in node.items):
+            return frozenset(i.value for i in node.items)
+    except TypeError:
+        # unhashable constant
+        pass
+    return None
+
+
+def _analyze(node) -> typing.Tuple[typing.Dict[str, typing.FrozenSet], bool]:
+    """Returns constraints required by expression and whether they are the whole expression."""
+    if isinstance(node, nodes.And):
+        left, left_exact = _analyze(node.left)
+        right, right_exact = _analyze(node.right)
+        for k, v in right.items():
+            left[k] = left[k] & v if k in left else v
+        return left, left_exact and right_exact
+
+    if isinstance(node, nodes.Compare) and len(node.ops) == 1:
+        op = node.ops[0]
+        if op.op == "eq":
+            for var, const in ((node.expr, op.expr), (op.expr, node.expr)):
+                path = _get_path(var)
+                values = _get_values(const) if isinstance(const, nodes.Const) else None
+                if path and values is not None:
+                    return {path: values}, True
+        elif op.op == "in" and isinstance(op.expr, (nodes.List, nodes.Tuple)):
+            # "in" on a string constant is a substring test, which cannot be indexed
+            path = _get_path(node.expr)
+            values = _get_values(op.expr)
+            if path and values is not None:
+                return {path: values}, True
+
+    return {}, False
+
+
+def resolve(context: typing.Mapping[str, typing.Any], path: str):
+    """Looks up dotted path the same way Jinja does, attributes first, then items."""
+    name, *attrs = path.split(".")
+    value = context.get(name, _MISSING)
+    for attr in attrs:
+        if value is _MISSING:
+            break
+        try:
+            value = getattr(value, attr)
+        except AttributeError:
+            try:
+                value = value[attr]
+            except (TypeError, LookupError):
+                value = _MISSING
+    return value
+
+
+class Selector(object):
+    """
+    Compiled selector expression with constraints extracted from it.
+
+    Expressions built only from ``var == const``, ``var in [consts]`` and ``and`` are evaluated
+    without Jinja, others fall back to compiled expression.
+    """
+
+    def __init__(self, source: str, expression: TemplateExpression, constraints: Constraints, exact: bool):
+        super().__init__()
+        self.source = source
+        self.expression = expression
+        self.constraints = constraints
+        self.exact = exact
+
+    @classmethod
+    def compile(cls, env: Environment, source: str) -> "Selector":
+        constraints, exact = _analyze(Parser(env, source, state="variable").parse_expression())
+        return cls(source, compile_expression(env, source), constraints, exact)
+
+    def __call__(self, **context):
+        if self.exact:
+            for path, values in self.constraints.items():
+                value = resolve(context, path)
+                if value is _MISSING or not isinstance(value, collections.abc.Hashable) or value not in values:
+                    return False
+            return True
+        return self.expression(**context)
+
+    def __repr__(self):
+        return "<%s: %r>" % (self.__class__.__qualname__, self.source)
+
+
+class SelectorIndex(object):
+    """
+    Dispatch index for named selectors.
+
+    Each selector with constraints is indexed under one of its constrained paths,
+    so only selectors that could match current values are evaluated.
+    """
+
+    def __init__(self, selectors: typing.Mapping[str, Selector]):
+        super().__init__()
+        self._order = dict((name, index) for index, name in enumerate(selectors))
+        self._selectors = dict(selectors)
+        self._index: typing.Dict[str, typing.Dict[typing.Hashable, typing.List[str]]] = {}
+        self._unindexed: typing.List[str] = []
+
+        for name, selector in selectors.items():
+            if not selector.constraints:
+                self._unindexed.append(name)
+                continue
+
+            # prefer path already used by other selectors, so lookups stay few
+            path = next((p for p in selector.constraints if p in self._index), None) or next(iter(selector.constraints))
+            by_value = self._index.setdefault(path, {})
+            for value in selector.constraints[path]:
+                by_value.setdefault(value, []).append(name)
+
+    def candidates(self, **context) -> typing.List[str]:
+        names = set(self._unindexed)
+        for path, by_value in self._index.items():
+            value = resolve(context, path)
+            if value is not _MISSING and isinstance(value, collections.abc.Hashable):
+                names.update(by_value.get(value, ()))
+        return sorted(names, key=self._order.__getitem__)
+
+    def match(self, **context) -> typing.Iterator[str]:
+        """Yields names of matching selectors, in original order."""
+        for name in self.candidates(**context):
+            if self._selectors[name](**context):
+                yield name
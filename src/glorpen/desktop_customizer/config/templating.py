@@ -1,5 +1,166 @@
+import collections
+import functools
+import hashlib
+import logging
+import os
+import pathlib
+import typing
+import weakref
+
 import jinja2
+import jinja2.meta
+from jinja2.environment import TemplateExpression
+
+logger = logging.getLogger(__name__)
+
+
+class SourceLoader(jinja2.BaseLoader):
+    """Templates are named by their own source, so compiled code can be stored in bytecode cache."""
+
+    def get_source(self, environment, template):
+        return template, None, lambda: True
+
+
+def get_cache_dir(name: str = "jinja") -> pathlib.Path:
+    base = os.environ.get("XDG_CACHE_HOME") or pathlib.Path("~/.cache").expanduser()
+    return pathlib.Path(base) / "glorpen-desktop-customizer" / name
+
+
+class DependencyCache(object):
+    """Names of context variables used by template sources, keyed by source digest and optionally kept on disk."""
+
+    def __init__(self, directory: typing.Optional[pathlib.Path] = None):
+        super().__init__()
+        self.directory = directory
+        self._items: typing.Dict[str, typing.FrozenSet[str]] = {}
+
+    def _read(self, key: str) -> typing.Optional[typing.FrozenSet[str]]:
+        try:
+            return frozenset((self.directory / key).read_text().split())
+        except OSError:
+            return None
+
+    def _write(self, key: str, names: typing.FrozenSet[str]):
+        tmp = self.directory / (".%s.tmp" % key)
+        try:
+            tmp.write_text("\n".join(sorted(names)))
+            tmp.replace(self.directory / key)
+        except OSError as e:
+            logger.warning("Could not store template dependencies in %s: %s", self.directory, e)
+
+    def get(self, source: str, factory: typing.Callable[[], typing.Iterable[str]]) -> typing.FrozenSet[str]:
+        key = hashlib.sha1(source.encode()).hexdigest()
+        names = self._items.get(key)
+        if names is None and self.directory:
+            names = self._read(key)
+        if names is None:
+            names = frozenset(factory())
+            if self.directory:
+                self._write(key, names)
+        self._items[key] = names
+        return names
+
+
+_dependency_caches: typing.MutableMapping[jinja2.Environment, DependencyCache] = weakref.WeakKeyDictionary()
+
+
+def create_environment(cache_dir: typing.Optional[pathlib.Path] = None) -> jinja2.Environment:
+    """Returns environment with compiled templates persisted in given (or default) directory."""
+    cache_dir = cache_dir or get_cache_dir()
+    bytecode_cache = None
+    dependencies_dir = cache_dir / "dependencies"
+    try:
+        dependencies_dir.mkdir(parents=True, exist_ok=True)
+        bytecode_cache = jinja2.FileSystemBytecodeCache(str(cache_dir))
+    except OSError as e:
+        logger.warning("Could not use bytecode cache in %s: %s", cache_dir, e)
+        dependencies_dir = None
+
+    # compiled templates are kept by CompiledCache, so internal cache would only hold duplicates
+    environment = jinja2.Environment(loader=SourceLoader(), bytecode_cache=bytecode_cache, cache_size=0)
+    _dependency_caches[environment] = DependencyCache(dependencies_dir)
+    return environment
+
+
+@functools.lru_cache(maxsize=None)
+def get_environment() -> jinja2.Environment:
+    """Returns shared environment using default cache directory, created on first use."""
+    return create_environment()
+
+
+def watch_fingerprint(expressions: typing.Iterable[typing.Callable], context: typing.Mapping[str, typing.Any]) -> bytes:
+    """Evaluates watch expressions and returns digest of their values."""
+    values = tuple(e(**context) for e in expressions)
+    return hashlib.sha1(repr(values).encode()).digest()
+
+
+def _load(environment: jinja2.Environment, source: str) -> jinja2.Template:
+    if isinstance(environment.loader, SourceLoader):
+        return environment.get_template(source)
+    return environment.from_string(source)
+
+
+def compile_template(environment: jinja2.Environment, source: str) -> jinja2.Template:
+    """Compiles template and records names of context variables it reads as ``dependencies`` attribute."""
+    template = _load(environment, source)
+    dependencies = _dependency_caches.get(environment)
+    if dependencies is None:
+        dependencies = _dependency_caches[environment] = DependencyCache()
+    # parsing is skipped for known sources, so templates loaded from bytecode cache are not compiled at all
+    template.dependencies = dependencies.get(
+        source, lambda: jinja2.meta.find_undeclared_variables(environment.parse(source))
+    )
+    return template
+
+
+def compile_expression(environment: jinja2.Environment, source: str) -> TemplateExpression:
+    """Same as :meth:`jinja2.Environment.compile_expression`, but goes through bytecode cache when available."""
+    if not isinstance(environment.loader, SourceLoader):
+        return environment.compile_expression(source)
+    # same template is built by Jinja, with expression assigned to "result" variable
+    return TemplateExpression(_load(environment, "{%% set result = (%s) %%}" % source), True)
+
+
+class CompiledCache(object):
+    """In-process LRU of compiled templates, expressions and selectors, keyed by their kind and source."""
+
+    def __init__(self, max_size: int = 1024):
+        super().__init__()
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._items: typing.MutableMapping[typing.Hashable, typing.Any] = collections.OrderedDict()
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def get(self, key: typing.Hashable, factory: typing.Callable[[], typing.Any]):
+        if key in self._items:
+            self.hits += 1
+            self._items.move_to_end(key)
+            return self._items[key]
+
+        self.misses += 1
+        value = self._items[key] = factory()
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+        return value
+
+
+_compiled_caches: typing.MutableMapping[jinja2.Environment, CompiledCache] = weakref.WeakKeyDictionary()
+
+
+def get_compiled_cache(environment: jinja2.Environment) -> CompiledCache:
+    """Returns cache shared by all users of given environment."""
+    cache = _compiled_caches.get(environment)
+    if cache is None:
+        cache = _compiled_caches[environment] = CompiledCache()
+    return cache
 
-env = jinja2.Environment(
 
-)
+def context_fingerprint(names: typing.Iterable[str], context: typing.Mapping[str, typing.Any]) -> bytes:
+    """Returns digest of given context variables, missing ones included."""
+    values = tuple((name, repr(context.get(name, jinja2.Undefined))) for name in sorted(names))
+    return hashlib.sha1(repr(values).encode()).digest()
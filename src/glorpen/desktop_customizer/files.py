@@ -0,0 +1,150 @@
+import asyncio
+import concurrent.futures
+import dataclasses
+import hashlib
+import logging
+import os
+import pathlib
+import tempfile
+import typing
+
+from glorpen.desktop_customizer.commands import CommandDispatcher
+from glorpen.desktop_customizer.config.model import FileConfig
+from glorpen.desktop_customizer.config.templating import context_fingerprint
+
+# read once, changing umask is not thread safe
+_UMASK = os.umask(0o022)
+os.umask(_UMASK)
+
+
+def write_atomic(target: pathlib.Path, data: bytes):
+    """Replaces file contents with rename, so readers never see partially written file."""
+    target.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=target.parent, prefix=".%s." % target.name)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        try:
+            mode = target.stat().st_mode & 0o7777
+        except FileNotFoundError:
+            # temp files are created as private
+            mode = 0o666 & ~_UMASK
+        os.chmod(tmp, mode)
+        os.replace(tmp, target)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def _digest_file(path: pathlib.Path) -> typing.Optional[bytes]:
+    try:
+        return hashlib.sha256(path.read_bytes()).digest()
+    except FileNotFoundError:
+        return None
+
+
+@dataclasses.dataclass(frozen=True)
+class _Rendered:
+    # identifies template or source and target, rendering again with same inputs gives same output
+    inputs: typing.Hashable
+    digest: bytes
+
+
+class FileRenderer(object):
+    """
+    Renders files from config to their targets.
+
+    File is rendered again only when its template, source or context variables it uses have changed,
+    and target is written only when rendered content differs from current one.
+    """
+
+    def __init__(self, dispatcher: CommandDispatcher, max_workers: int = 4):
+        super().__init__()
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        # shared with other users, so concurrency limit and coalescing apply to reload commands too
+        self.dispatcher = dispatcher
+
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="FileRenderer")
+        self._rendered: typing.Dict[str, _Rendered] = {}
+
+        # files rendered and skipped because of unchanged inputs
+        self.executed = 0
+        self.skipped = 0
+
+    def _get_inputs(self, config: FileConfig, context: typing.Mapping[str, typing.Any]) -> typing.Hashable:
+        if config.template is not None:
+            return config.target, id(config.template), context_fingerprint(config.template.dependencies, context)
+
+        try:
+            stat = config.src.stat()
+        except FileNotFoundError:
+            return config.target, config.src, None
+        return config.target, config.src, stat.st_mtime_ns, stat.st_size
+
+    def _render(self, name: str, config: FileConfig, context: typing.Mapping[str, typing.Any]) -> typing.Optional[bool]:
+        """Returns whether target was written, or None when rendering was skipped."""
+        inputs = self._get_inputs(config, context)
+        previous = self._rendered.get(name)
+        if previous and previous.inputs == inputs:
+            return None
+
+        if config.template is not None:
+            data = config.template.render(**context).encode()
+        else:
+            data = config.src.read_bytes()
+
+        digest = hashlib.sha256(data).digest()
+        # target could be changed outside, so it is checked when not rendered before
+        current = previous.digest if previous and previous.inputs[0] == config.target else _digest_file(config.target)
+        self._rendered[name] = _Rendered(inputs=inputs, digest=digest)
+
+        if digest == current:
+            self.logger.debug("File %r is up to date", name)
+            return False
+
+        self.logger.info("Writing %s", config.target)
+        write_atomic(config.target, data)
+        return True
+
+    async def render(self, files: typing.Mapping[str, FileConfig], context: typing.Mapping[str, typing.Any]) -> typing.List[str]:
+        """Renders all files concurrently, returns names of ones with changed targets."""
+        for name in self._rendered.keys() - files.keys():
+            del self._rendered[name]
+
+        loop = asyncio.get_running_loop()
+        names = list(files.keys())
+        results = await asyncio.gather(
+            *(loop.run_in_executor(self._executor, self._render, name, files[name], context) for name in names),
+            return_exceptions=True
+        )
+
+        changed = []
+        for name, result in zip(names, results):
+            if isinstance(result, Exception):
+                self.logger.error("Could not render file %r: %s", name, result)
+                # try again next time
+                self._rendered.pop(name, None)
+            elif result is None:
+                self.skipped += 1
+            else:
+                self.executed += 1
+                if result:
+                    changed.append(name)
+        return changed
+
+    async def apply(self, files: typing.Mapping[str, FileConfig], context: typing.Mapping[str, typing.Any]) -> typing.List[str]:
+        """Renders files and runs reload commands of changed ones."""
+        changed = await self.render(files, context)
+
+        # files sharing reload command are coalesced by dispatcher
+        await asyncio.gather(*(
+            self.dispatcher.run(files[name].reload_command) for name in changed if files[name].reload_command
+        ))
+
+        return changed
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
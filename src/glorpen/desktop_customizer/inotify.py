@@ -0,0 +1,110 @@
+import ctypes
+import ctypes.util
+import dataclasses
+import os
+import pathlib
+import struct
+import typing
+
+from glorpen.desktop_customizer.aio import wait_readable
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+# changes of files in watched directory, including ones replaced by editors with rename
+IN_DIR_CHANGES = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+_EVENT_HEADER = struct.Struct("iIII")
+
+_libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+
+
+@dataclasses.dataclass(frozen=True)
+class InotifyEvent:
+    path: pathlib.Path
+    mask: int
+    cookie: int
+
+
+class Inotify(object):
+    """Minimal inotify binding, events are read without blocking the event loop."""
+
+    def __init__(self):
+        super().__init__()
+
+        self._fd = _libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        self._watches: typing.Dict[int, pathlib.Path] = {}
+
+    def fileno(self) -> int:
+        return self._fd
+
+    def add_watch(self, path: pathlib.Path, mask: int = IN_DIR_CHANGES) -> int:
+        wd = _libc.inotify_add_watch(self._fd, os.fsencode(path), ctypes.c_uint32(mask))
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), str(path))
+        self._watches[wd] = path
+        return wd
+
+    def remove_watch(self, wd: int):
+        if self._watches.pop(wd, None) is not None:
+            _libc.inotify_rm_watch(self._fd, wd)
+
+    def remove_all(self):
+        for wd in list(self._watches):
+            self.remove_watch(wd)
+
+    def read(self) -> typing.List[InotifyEvent]:
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+
+            if mask & IN_IGNORED:
+                # watch was removed, eg. because watched path was deleted
+                self._watches.pop(wd, None)
+                continue
+
+            path = self._watches.get(wd)
+            if path is None and not mask & IN_Q_OVERFLOW:
+                continue
+
+            if name:
+                path = path / os.fsdecode(name)
+
+            events.append(InotifyEvent(path=path, mask=mask, cookie=cookie))
+
+        return events
+
+    async def wait(self) -> typing.List[InotifyEvent]:
+        while True:
+            events = self.read()
+            if events:
+                return events
+            await wait_readable(self._fd)
+
+    def close(self):
+        self._watches.clear()
+        os.close(self._fd)
@@ -1,17 +1,92 @@
-import os
+import collections
+import dataclasses
+import datetime
 import xcffib
 import time
 import xcffib.randr
 import logging
 import asyncio
+import typing
 
 from xcffib.randr import Rotation
 
+from glorpen.desktop_customizer.aio import Worker
+from glorpen.desktop_customizer.whereami.hints import MonitorHint
+from glorpen.desktop_customizer.whereami.xrand import query_randr_state, create_monitor_hint
+from glorpen.desktop_customizer.xserver import XConnection
+
 def get_rotated_sizing(rotation, original_size):
     if rotation in (Rotation.Rotate_90, Rotation.Rotate_270):
         return (original_size[1], original_size[0])
     return tuple(original_size)
 
+@dataclasses.dataclass(frozen=True)
+class CrtcConfig:
+    crtc: int
+    x: int = 0
+    y: int = 0
+    mode: int = 0
+    rotation: int = Rotation.Rotate_0
+    outputs: typing.Tuple[int, ...] = ()
+
+    @classmethod
+    def from_info(cls, crtc, crtc_info):
+        if crtc_info.mode == 0:
+            # disabled crtc can have leftover position and rotation
+            return cls(crtc)
+        return cls(crtc, crtc_info.x, crtc_info.y, crtc_info.mode, crtc_info.rotation, tuple(crtc_info.outputs))
+
+
+@dataclasses.dataclass(frozen=True)
+class LayoutPlan:
+    """Target state for a set of monitors, independent of what is currently configured."""
+    crtcs: typing.Tuple[CrtcConfig, ...]
+    # connected outputs that should be turned off
+    disabled_outputs: typing.Tuple[int, ...]
+    primary: typing.Optional[int]
+    screen_size: typing.Tuple[int, int, int, int]
+
+
+@dataclasses.dataclass(frozen=True)
+class LayoutChanges:
+    """Changes made by :meth:`LayoutManager.apply`, evaluates to False when nothing was changed."""
+    crtcs: typing.Tuple[CrtcConfig, ...] = ()
+    primary: typing.Optional[int] = None
+    screen_size: typing.Optional[typing.Tuple[int, int, int, int]] = None
+
+    def __bool__(self):
+        return bool(self.crtcs or self.primary is not None or self.screen_size is not None)
+
+    @property
+    def disabled(self):
+        return tuple(c.crtc for c in self.crtcs if not c.mode)
+
+def allocate_crtcs(candidates, available):
+    """
+    Assigns distinct crtc to every output, as bipartite matching of outputs and crtcs able to drive them.
+
+    Candidates are tried in given order, so listing currently used crtc first keeps it when possible.
+    Returns None when some output cannot get any crtc.
+    """
+    owners = {}
+
+    def assign(output, visited):
+        for crtc in candidates[output]:
+            if crtc not in available or crtc in visited:
+                continue
+            visited.add(crtc)
+            # take free crtc or move its owner to other one
+            if crtc not in owners or assign(owners[crtc], visited):
+                owners[crtc] = output
+                return True
+        return False
+
+    for output in candidates:
+        if not assign(output, set()):
+            return None
+
+    return dict((output, crtc) for crtc, output in owners.items())
+
 class LayoutHint(object):
     edid_name = None
     edid_serial = None
@@ -35,52 +110,63 @@ class LayoutHint(object):
 
 class LayoutManager(object):
     def _get_atom_id(self, name):
-        return self.conn.core.InternAtom(False, len(name), name).reply().atom
+        return self._x.get_atom_id(name)
     
-    def __init__(self):
+    def __init__(
+            self,
+            timeout: datetime.timedelta = datetime.timedelta(seconds=30),
+            x_connection: typing.Optional[XConnection] = None,
+            plan_cache_size: int = 16
+    ):
         super().__init__()
         self.logger = logging.getLogger(self.__class__.__name__)
+        self._x = x_connection or XConnection()
         self.layouts = []
+        self._timeout = timeout
+        self._plans: typing.MutableMapping[typing.Hashable, LayoutPlan] = collections.OrderedDict()
+        self._plan_cache_size = plan_cache_size
     
     def add_layout(self, layout):
         self.layouts.append(layout)
 
     def connect(self):
-        self.conn = xcffib.connect(os.environ.get("DISPLAY"))
-        self.ext_r = self.conn(xcffib.randr.key)
+        self._worker = Worker(self.__class__.__name__, timeout=self._timeout)
+        self._x.connect()
+        self.conn = self._x.conn
+        self.ext_r = self._x.randr
     
     def disconnect(self):
-        self.conn.disconnect()
-
-    def get_crt_for_output(self, output, output_info = None):
-        if output_info is None:
-            output_info = self.ext_r.GetOutputInfo(output, 0).reply()
-        
-        for crtc in output_info.crtcs:
-            crtc_info = self.ext_r.GetCrtcInfo(crtc, 0).reply()
-            # TODO: more checking if crt is usable
-            if crtc_info.num_outputs == 0 and output in crtc_info.possible.list:
-                return crtc
-        # error if no crtc found?
-
-    def disable_crtc(self, crtc):
-        self.logger.debug("Disabling crtc %r", crtc)
+        self._worker.shutdown()
+        self._x.disconnect()
+
+    def get_crtc_candidates(self, output, crtcs, crtc_infos, current_crtc=None):
+        candidates = [c for c in crtcs if output in crtc_infos[c].possible]
+        if current_crtc in candidates:
+            candidates.remove(current_crtc)
+            candidates.insert(0, current_crtc)
+        return candidates
+
+    def get_available_crtcs(self, crtc_infos, managed_outputs):
+        """Returns crtcs that are unused or drive only given outputs."""
+        return set(
+            crtc for crtc, info in crtc_infos.items()
+            if not info.mode or managed_outputs.issuperset(info.outputs)
+        )
+
+    def set_crtc_config(self, config: CrtcConfig):
+        self.logger.debug("Configuring %r", config)
         self.ext_r.SetCrtcConfig(
-            crtc,
-            0,
-            0,
-            0,
+            config.crtc,
             0,
             0,
-            Rotation.Rotate_0,
-            0,
-            []
+            config.x,
+            config.y,
+            config.mode,
+            config.rotation,
+            len(config.outputs),
+            list(config.outputs)
         ).reply()
-    
-    def disable_crtcs(self, crtcs):
-        for crtc in crtcs:
-            self.disable_crtc(crtc)
-    
+
     def get_screen_sizes(self, outputs_data):
         """Returns max width and height in pixels and
         approximate physical width and height for whole screen"""
@@ -107,12 +193,15 @@ class LayoutManager(object):
         
         return max_x, max_y, int(max_x * dim_ratio), int(max_y * dim_ratio)
 
-    def gather_output_data(self, screen_resources, hints):
+    def gather_output_data(self, screen_resources, hints, output_infos=None):
         screen_modes = dict((m.id, m) for m in screen_resources.modes)
 
+        if output_infos is None:
+            output_infos = query_randr_state(self.ext_r, outputs=screen_resources.outputs).outputs
+
         outputs_data = []
         for output in screen_resources.outputs:
-            output_info = self.ext_r.GetOutputInfo(output, 0).reply()
+            output_info = output_infos[output]
             
             # skip outputs without monitors
             if output_info.connection == 0:
@@ -128,6 +217,7 @@ class LayoutManager(object):
                     },
                     "info": {
                         "crtc": output_info.crtc if output_info.crtc > 0 else None, # 0 is NULL
+                        "crtcs": list(output_info.crtcs),
                         "mm_height": hints[output].height_mm
                     },
                     "output": output,
@@ -166,42 +256,130 @@ class LayoutManager(object):
             outputs_to_update
         ]
 
-    def apply_crtc_configs(self, outputs_to_update, root):
-        self.logger.debug("Updating crtcs")
+    def get_crtc_configs(self, outputs_to_update, crtc_infos, managed_outputs):
+        candidates = dict(
+            (
+                od["output"],
+                self.get_crtc_candidates(od["output"], od["info"]["crtcs"], crtc_infos, od["info"]["crtc"])
+            )
+            for od in outputs_to_update
+        )
+        allocation = allocate_crtcs(candidates, self.get_available_crtcs(crtc_infos, managed_outputs))
+        if allocation is None:
+            raise Exception("No crtc found for outputs %s" % ", ".join(od["name"] for od in outputs_to_update))
+
+        configs = []
         for output_data in outputs_to_update:
             placement = output_data["placement"]
 
-            crtc = output_data["info"]["crtc"]
-            if crtc is None:
-                crtc = self.get_crt_for_output(output_data["output"])
-
-                if crtc is None:
-                    raise Exception("No crtc found for output %s" % output_data["name"])
-            
-            crtc_outputs = [output_data["output"]]
-
-            self.ext_r.SetCrtcConfig(
-                crtc,
-                0,
-                0,
+            configs.append(CrtcConfig(
+                allocation[output_data["output"]],
                 placement.position[0],
                 placement.position[1],
                 output_data["mode"]["id"],
                 placement.rotation,
-                len(crtc_outputs),
-                crtc_outputs
-            ).reply()
+                (output_data["output"],)
+            ))
+
+        return configs
+
+    def get_plan(self, layout, outputs_data, crtc_infos) -> LayoutPlan:
+        _, outputs_to_update = self.get_configs_for_layout(layout, outputs_data)
+        placed = set(od["output"] for od in outputs_to_update)
+        # crtcs of connected outputs are reassigned or disabled anyway
+        managed_outputs = set(od["output"] for od in outputs_data)
 
-            if placement.primary:
-                self.logger.debug("Setting primary output to %s", output_data["name"])
-                self.ext_r.SetOutputPrimary(root, output_data["output"])
+        primary = None
+        for output_data in outputs_to_update:
+            if output_data["placement"].primary:
+                primary = output_data["output"]
+
+        return LayoutPlan(
+            crtcs=tuple(self.get_crtc_configs(outputs_to_update, crtc_infos, managed_outputs)),
+            disabled_outputs=tuple(od["output"] for od in outputs_data if od["output"] not in placed),
+            primary=primary,
+            screen_size=self.get_screen_sizes(outputs_to_update),
+        )
+
+    def get_plan_key(self, output_infos, hints) -> typing.Optional[typing.Hashable]:
+        """Fingerprint of connected monitors and layouts state, None if plan should not be cached."""
+        layouts = tuple(l.get_fingerprint() for l in self.layouts)
+        if None in layouts:
+            return None
+
+        outputs = tuple(
+            (output, info.modes[0], hints[output].monitor_name, hints[output].monitor_serial)
+            for output, info in sorted(output_infos.items())
+            if info.connection == 0
+        )
+        return outputs, layouts
+
+    def _get_cached_plan(self, key) -> typing.Optional[LayoutPlan]:
+        if key is None or key not in self._plans:
+            return None
+        self._plans.move_to_end(key)
+        return self._plans[key]
+
+    def _cache_plan(self, key, plan: LayoutPlan):
+        if key is None:
+            return
+        self._plans[key] = plan
+        while len(self._plans) > self._plan_cache_size:
+            self._plans.popitem(last=False)
+
+    def is_plan_usable(self, plan: LayoutPlan, crtc_infos) -> bool:
+        """Checks that crtcs assigned by plan still exist, can drive their outputs and are not used by other ones."""
+        managed_outputs = set(plan.disabled_outputs).union(*(c.outputs for c in plan.crtcs))
+        available = self.get_available_crtcs(crtc_infos, managed_outputs)
+
+        for config in plan.crtcs:
+            if config.crtc not in available:
+                return False
+            if not set(config.outputs).issubset(crtc_infos[config.crtc].possible):
+                return False
+        return True
+
+    def get_changes(self, plan: LayoutPlan, crtc_infos, current_primary, current_size) -> LayoutChanges:
+        """Returns only settings that differ from current ones."""
+        targets = dict((c.crtc, c) for c in plan.crtcs)
+        managed_outputs = set(plan.disabled_outputs).union(*(c.outputs for c in plan.crtcs))
+
+        # crtcs are freed first, so outputs can be moved to other ones
+        crtcs = [
+            CrtcConfig(crtc) for crtc, info in crtc_infos.items()
+            if crtc not in targets and info.mode and managed_outputs.intersection(info.outputs)
+        ]
+        crtcs.extend(c for c in plan.crtcs if CrtcConfig.from_info(c.crtc, crtc_infos[c.crtc]) != c)
 
-        max_x, max_y, dim_x, dim_y = self.get_screen_sizes(outputs_to_update)
-        self.logger.debug("Setting screen size to %dx%d (%dmm x %dmm)", max_x, max_y, dim_x, dim_y)
-        self.ext_r.SetScreenSize(root, max_x, max_y, dim_x, dim_y)
+        return LayoutChanges(
+            crtcs=tuple(crtcs),
+            primary=plan.primary if plan.primary not in (None, current_primary) else None,
+            screen_size=plan.screen_size if plan.screen_size[0:2] != current_size else None,
+        )
+
+    def apply_changes(self, changes: LayoutChanges, root):
+        self.logger.debug("Updating crtcs")
+        for config in changes.crtcs:
+            self.set_crtc_config(config)
+
+        if changes.primary is not None:
+            self.logger.debug("Setting primary output to %s", changes.primary)
+            self.ext_r.SetOutputPrimary(root, changes.primary)
+
+        if changes.screen_size is not None:
+            self.logger.debug("Setting screen size to %dx%d (%dmm x %dmm)", *changes.screen_size)
+            self.ext_r.SetScreenSize(root, *changes.screen_size)
 
         self.conn.flush()
 
+    def get_output_hints(self, output_infos, hints: typing.Iterable[MonitorHint]) -> typing.Dict[int, MonitorHint]:
+        """Maps monitor hints to outputs by name, outputs without hint (eg. connected just now) get one without EDID."""
+        by_name = dict((h.output_name, h) for h in hints)
+        return dict(
+            (output, by_name.get(info.name.raw.decode()) or create_monitor_hint(info, None))
+            for output, info in output_infos.items()
+        )
+
     def get_hints_from_outputs_data(self, outputs_data):
         hints = []
         for od in outputs_data:
@@ -209,18 +387,31 @@ class LayoutManager(object):
             hints.append(h)
         return hints
 
-    async def apply(self, hints):
-        # configured_outputs = []
+    async def apply(self, hints: typing.Iterable[MonitorHint]) -> LayoutChanges:
+        try:
+            return await self._worker.call(self._apply, hints)
+        finally:
+            self._x.flush()
 
-        root = self.conn.get_setup().roots[0].root
+    def _apply(self, hints) -> LayoutChanges:
+        root = self._x.root
 
-        # grab server when changing stuff to accumulate events
-        self.logger.debug("Grabbing server")
-        self.conn.core.GrabServer()
+        geometry_cookie = self.conn.core.GetGeometry(root)
+        primary_cookie = self.ext_r.GetOutputPrimary(root)
+        screen_resources = self.ext_r.GetScreenResources(root).reply()
 
-        try:
-            screen_resources = self.ext_r.GetScreenResources(root).reply()
-            outputs_data = self.gather_output_data(screen_resources, hints)
+        state = query_randr_state(self.ext_r, outputs=screen_resources.outputs, crtcs=screen_resources.crtcs)
+        hints = self.get_output_hints(state.outputs, hints)
+
+        key = self.get_plan_key(state.outputs, hints)
+        plan = self._get_cached_plan(key)
+
+        if plan is not None and not self.is_plan_usable(plan, state.crtcs):
+            self.logger.debug("Cached layout plan uses crtcs that are no longer available")
+            plan = None
+
+        if plan is None:
+            outputs_data = self.gather_output_data(screen_resources, hints, state.outputs)
             layout_hints = self.get_hints_from_outputs_data(outputs_data)
 
             layout = None
@@ -229,19 +420,35 @@ class LayoutManager(object):
                     layout = l
                     break
 
-            if layout:
-                crtcs_to_disable, outputs_to_update = self.get_configs_for_layout(layout, outputs_data)
-                self.disable_crtcs(crtcs_to_disable)
-                self.apply_crtc_configs(outputs_to_update, root)
-            else:
+            if not layout:
                 self.logger.warning("No layout found")
+                return LayoutChanges()
+
+            plan = self.get_plan(layout, outputs_data, state.crtcs)
+            self._cache_plan(key, plan)
+        else:
+            self.logger.debug("Using cached layout plan")
+
+        geometry = geometry_cookie.reply()
+        changes = self.get_changes(plan, state.crtcs, primary_cookie.reply().output, (geometry.width, geometry.height))
+
+        if not changes:
+            self.logger.debug("Layout is already applied")
+            return changes
+
+        # grab server when changing stuff to accumulate events
+        self.logger.debug("Grabbing server")
+        self.conn.core.GrabServer()
+
+        try:
+            self.apply_changes(changes, root)
         finally:
             self.conn.flush()
             self.logger.debug("Ungrabbing server")
             self.conn.core.UngrabServer()
             self.conn.flush()
 
-            # self.conn.disconnect()
+        return changes
 
 class Placement(object):
     primary = False
@@ -255,6 +462,9 @@ class Placement(object):
     
     def __repr__(self):
         return "<%s: %r>" % (self.__class__.__qualname__, self.__dict__)
+
+    def get_fingerprint(self):
+        return tuple(self.position), self.rotation, self.primary
     
 class Layout(object):
     def __init__(self):
@@ -262,6 +472,10 @@ class Layout(object):
 
     def fit(self, layout_hints):
         return False
+
+    def get_fingerprint(self) -> typing.Optional[typing.Hashable]:
+        """Hashable state that placements depend on, plans for layouts returning None are not cached."""
+        return None
     
     def get_placement_for_output(self, output):
         raise NotImplementedError()
@@ -0,0 +1,521 @@
+import asyncio
+import collections
+import dataclasses
+import io
+import logging
+import os
+import pathlib
+import random
+import sqlite3
+import struct
+import typing
+
+import xcffib
+import xcffib.xproto
+from PIL import Image, ImageOps
+
+from glorpen.desktop_customizer.aio import Worker, wait_readable
+from glorpen.desktop_customizer.inotify import Inotify, IN_ISDIR, IN_MOVED_FROM, IN_DELETE, IN_DELETE_SELF, \
+    IN_MOVE_SELF, IN_Q_OVERFLOW
+
+IMAGE_EXTENSIONS = frozenset([".jpg", ".jpeg", ".png", ".webp", ".bmp", ".gif"])
+
+# images with aspect ratios rounded to same value are interchangeable
+ASPECT_PRECISION = 1
+
+_PUT_IMAGE_OPCODE = 72
+_PUT_IMAGE_HEADER = struct.Struct("=xB2xIIHHhhBB2x")
+
+
+@dataclasses.dataclass(frozen=True)
+class Monitor:
+    x: int
+    y: int
+    width: int
+    height: int
+    name: typing.Optional[str] = None
+
+    @property
+    def aspect(self) -> float:
+        return self.width / self.height
+
+    @property
+    def portrait(self) -> bool:
+        return self.height > self.width
+
+
+@dataclasses.dataclass(frozen=True)
+class ImageInfo:
+    path: pathlib.Path
+    mtime_ns: int
+    width: int
+    height: int
+
+    @property
+    def aspect(self) -> float:
+        return self.width / self.height
+
+    @property
+    def portrait(self) -> bool:
+        return self.height > self.width
+
+
+def read_image_info(path: pathlib.Path, mtime_ns: int) -> typing.Optional[ImageInfo]:
+    """Reads only image header, pixel data is not decoded."""
+    try:
+        with Image.open(path) as img:
+            width, height = img.size
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+
+    if not width or not height:
+        return None
+
+    return ImageInfo(path=path, mtime_ns=mtime_ns, width=width, height=height)
+
+
+def _is_image(path: pathlib.Path):
+    return path.suffix.lower() in IMAGE_EXTENSIONS
+
+
+class DictCache(object):
+    """Image metadata kept only in memory."""
+
+    def __init__(self):
+        super().__init__()
+        self._items: typing.Dict[pathlib.Path, ImageInfo] = {}
+
+    def items(self) -> typing.Iterable[ImageInfo]:
+        return list(self._items.values())
+
+    def put(self, info: ImageInfo):
+        self._items[info.path] = info
+
+    def remove(self, path: pathlib.Path):
+        self._items.pop(path, None)
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class SqliteCache(object):
+    """Image metadata persisted in SQLite database, so only new or modified images are read on start."""
+
+    def __init__(self, path: pathlib.Path):
+        super().__init__()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # created by caller, but then used only from ImageFinder worker thread
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS images ("
+            "path TEXT PRIMARY KEY, mtime_ns INTEGER NOT NULL, width INTEGER NOT NULL, height INTEGER NOT NULL, "
+            "aspect REAL NOT NULL, portrait INTEGER NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS images_shape ON images (portrait, aspect)")
+        self._db.commit()
+
+    def items(self) -> typing.Iterable[ImageInfo]:
+        return [
+            ImageInfo(path=pathlib.Path(p), mtime_ns=m, width=w, height=h)
+            for p, m, w, h in self._db.execute("SELECT path, mtime_ns, width, height FROM images")
+        ]
+
+    def put(self, info: ImageInfo):
+        self._db.execute(
+            "INSERT OR REPLACE INTO images (path, mtime_ns, width, height, aspect, portrait) VALUES (?, ?, ?, ?, ?, ?)",
+            (str(info.path), info.mtime_ns, info.width, info.height, info.aspect, info.portrait)
+        )
+
+    def remove(self, path: pathlib.Path):
+        # removes images in given directory too
+        self._db.execute(
+            "DELETE FROM images WHERE path = ? OR substr(path, 1, ?) = ?",
+            (str(path), len(str(path)) + 1, str(path) + os.sep)
+        )
+
+    def commit(self):
+        self._db.commit()
+
+    def close(self):
+        self._db.close()
+
+
+class _Bucket(object):
+    """Set of paths with O(1) add, remove and random choice."""
+
+    def __init__(self):
+        super().__init__()
+        self._items: typing.List[pathlib.Path] = []
+        self._positions: typing.Dict[pathlib.Path, int] = {}
+
+    def __len__(self):
+        return len(self._items)
+
+    def add(self, path: pathlib.Path):
+        if path not in self._positions:
+            self._positions[path] = len(self._items)
+            self._items.append(path)
+
+    def discard(self, path: pathlib.Path):
+        position = self._positions.pop(path, None)
+        if position is None:
+            return
+        last = self._items.pop()
+        if last != path:
+            self._items[position] = last
+            self._positions[last] = position
+
+    def choice(self, exclude: typing.Container[pathlib.Path], tries: int = 16) -> typing.Optional[pathlib.Path]:
+        if not self._items:
+            return None
+        for _ in range(tries):
+            path = random.choice(self._items)
+            if path not in exclude:
+                return path
+        # mostly excluded bucket, fall back to full scan
+        left = [p for p in self._items if p not in exclude]
+        return random.choice(left) if left else None
+
+
+class ImageFinder(object):
+    """
+    Index of images in wallpaper directory.
+
+    Images are grouped by orientation and rounded aspect ratio, so picking one for a monitor does not scan the index.
+    Index and its cache are read and modified only in finder worker thread.
+    """
+
+    def __init__(self, path: pathlib.Path, cache=None):
+        super().__init__()
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.path = pathlib.Path(path)
+        self.cache = DictCache() if cache is None else cache
+
+        self._images: typing.Dict[pathlib.Path, ImageInfo] = {}
+        self._all = _Bucket()
+        self._by_orientation: typing.Dict[bool, _Bucket] = {}
+        self._by_shape: typing.Dict[typing.Tuple[bool, float], _Bucket] = {}
+        self._loaded = False
+
+        self._worker = Worker(self.__class__.__name__)
+        self._inotify: typing.Optional[Inotify] = None
+
+    def __len__(self):
+        return len(self._images)
+
+    @classmethod
+    def _get_shape(cls, item) -> typing.Tuple[bool, float]:
+        return item.portrait, round(item.aspect, ASPECT_PRECISION)
+
+    def _add(self, info: ImageInfo):
+        self._discard(info.path)
+        self._images[info.path] = info
+        self._all.add(info.path)
+        self._by_orientation.setdefault(info.portrait, _Bucket()).add(info.path)
+        self._by_shape.setdefault(self._get_shape(info), _Bucket()).add(info.path)
+
+    def _discard(self, path: pathlib.Path):
+        info = self._images.pop(path, None)
+        if info is None:
+            return
+        self._all.discard(path)
+        self._by_orientation[info.portrait].discard(path)
+        self._by_shape[self._get_shape(info)].discard(path)
+
+    def _load(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        for info in self.cache.items():
+            self._add(info)
+
+    def _update_file(self, path: pathlib.Path, stat: typing.Optional[os.stat_result] = None):
+        if not _is_image(path):
+            return
+
+        try:
+            stat = stat or path.stat()
+        except OSError:
+            self._remove(path)
+            return
+
+        known = self._images.get(path)
+        if known and known.mtime_ns == stat.st_mtime_ns:
+            return
+
+        info = read_image_info(path, stat.st_mtime_ns)
+        if info is None:
+            self.logger.debug("Skipping unreadable image %s", path)
+            self._remove(path)
+            return
+
+        self._add(info)
+        self.cache.put(info)
+
+    def _remove(self, path: pathlib.Path):
+        """Removes image or all images in directory."""
+        if path in self._images:
+            self._discard(path)
+        else:
+            for p in [p for p in self._images if path in p.parents]:
+                self._discard(p)
+        self.cache.remove(path)
+
+    def _scan_dir(self, path: pathlib.Path) -> typing.Set[pathlib.Path]:
+        found = set()
+        try:
+            entries = list(os.scandir(path))
+        except OSError as e:
+            self.logger.warning("Could not scan %s: %s", path, e)
+            return found
+
+        for entry in entries:
+            p = pathlib.Path(entry.path)
+            if entry.is_dir():
+                found.update(self._scan_dir(p))
+                if self._inotify:
+                    self._add_watch(p)
+            elif entry.is_file():
+                found.add(p)
+                self._update_file(p, entry.stat())
+
+        return found
+
+    def scan(self):
+        """Synchronizes index with directory, only headers of new and modified images are read."""
+        self._load()
+        found = self._scan_dir(self.path)
+        for path in set(self._images) - found:
+            self._discard(path)
+            self.cache.remove(path)
+        self.cache.commit()
+        self.logger.debug("Indexed %d images", len(self._images))
+
+    def _add_watch(self, path: pathlib.Path):
+        try:
+            self._inotify.add_watch(path)
+        except OSError as e:
+            self.logger.warning("Could not watch %s: %s", path, e)
+
+    def _apply_events(self, events):
+        for ev in events:
+            if ev.mask & IN_Q_OVERFLOW:
+                self.logger.warning("Inotify queue overflow, rescanning images")
+                self._inotify.remove_all()
+                self._add_watch(self.path)
+                self.scan()
+                return
+
+            if ev.mask & (IN_MOVED_FROM | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF):
+                self._remove(ev.path)
+            elif ev.mask & IN_ISDIR:
+                self._add_watch(ev.path)
+                self._scan_dir(ev.path)
+            else:
+                self._update_file(ev.path)
+
+        self.cache.commit()
+
+    def _start_watching(self) -> int:
+        self._inotify = Inotify()
+        self._add_watch(self.path)
+        self.scan()
+        return self._inotify.fileno()
+
+    def _read_events(self):
+        events = self._inotify.read()
+        if events:
+            self._apply_events(events)
+
+    def _stop_watching(self):
+        self._inotify.close()
+        self._inotify = None
+
+    async def watch(self):
+        """Keeps index updated until cancelled."""
+        fd = await self._worker.call(self._start_watching)
+        try:
+            while True:
+                await wait_readable(fd)
+                await self._worker.call(self._read_events)
+        finally:
+            await self._worker.call(self._stop_watching)
+
+    async def close(self):
+        """Closes index cache and stops worker."""
+        try:
+            # cache is used only from worker thread
+            await self._worker.call(self.cache.close)
+        except asyncio.TimeoutError:
+            self.logger.error("Timed out while closing image cache")
+        finally:
+            self._worker.shutdown()
+
+    def _choose(self, monitor: typing.Optional[Monitor], exclude) -> typing.Optional[pathlib.Path]:
+        buckets = []
+        if monitor:
+            buckets.append(self._by_shape.get(self._get_shape(monitor)))
+            buckets.append(self._by_orientation.get(monitor.portrait))
+        buckets.append(self._all)
+
+        for bucket in buckets:
+            if bucket:
+                path = bucket.choice(exclude)
+                if path:
+                    return path
+        return None
+
+    def _get_unique_random(self, count, exclude, monitors) -> typing.List[pathlib.Path]:
+        self._load()
+        if not self._images:
+            self.scan()
+
+        chosen = []
+        exclude = set(exclude)
+        for i in range(count):
+            monitor = monitors[i] if i < len(monitors) else None
+            path = self._choose(monitor, exclude) or self._choose(monitor, set(chosen))
+            if path is None:
+                break
+            chosen.append(path)
+            exclude.add(path)
+
+        return chosen
+
+    async def get_unique_random(
+            self,
+            count: int,
+            exclude: typing.Iterable[pathlib.Path] = (),
+            monitors: typing.Sequence[Monitor] = ()
+    ) -> typing.List[pathlib.Path]:
+        """
+        Returns up to ``count`` distinct images, preferring ones with shape of corresponding monitor.
+
+        Images from ``exclude`` are used only when there is nothing else to choose.
+        """
+        return await self._worker.call(self._get_unique_random, count, tuple(exclude), tuple(monitors))
+
+
+def render_image(path: pathlib.Path, width: int, height: int) -> bytes:
+    """Returns image scaled and cropped to cover given size, as 32bit BGRX pixels."""
+    with Image.open(path) as img:
+        # lets JPEG decoder downscale while decoding
+        img.draft("RGB", (width, height))
+        img = ImageOps.fit(img.convert("RGB"), (width, height), Image.Resampling.LANCZOS)
+        return img.tobytes("raw", "BGRX")
+
+
+class RenderCache(object):
+    """
+    Rendered images keyed by image, its mtime and target size.
+
+    Least recently used renders are evicted when total size exceeds ``max_size`` bytes.
+    """
+
+    def __init__(self, max_size: int = 256 * 1024 * 1024):
+        super().__init__()
+        self.max_size = max_size
+        self.size = 0
+        self._items: typing.MutableMapping[typing.Hashable, bytes] = collections.OrderedDict()
+
+    def get(self, path: pathlib.Path, width: int, height: int) -> bytes:
+        key = (path, path.stat().st_mtime_ns, width, height)
+
+        data = self._items.get(key)
+        if data is not None:
+            self._items.move_to_end(key)
+            return data
+
+        data = render_image(path, width, height)
+        if len(data) > self.max_size:
+            return data
+
+        self._items[key] = data
+        self.size += len(data)
+        while self.size > self.max_size:
+            _, evicted = self._items.popitem(last=False)
+            self.size -= len(evicted)
+
+        return data
+
+
+class PictureWriter(object):
+    """
+    Draws images on root window pixmap and publishes it for compositors and terminals.
+
+    Pixmap is kept after disconnecting, previous one is freed by killing its owner (same as other root setters do).
+    """
+
+    def __init__(self, cache: typing.Optional[RenderCache] = None, display: typing.Optional[str] = None):
+        super().__init__()
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.cache = RenderCache() if cache is None else cache
+        self._display = display
+        self._pictures: typing.List[typing.Tuple[pathlib.Path, Monitor]] = []
+
+    def connect(self):
+        self.conn = xcffib.connect(self._display or os.environ.get("DISPLAY"))
+        screen = self.conn.get_setup().roots[0]
+        self.root = screen.root
+        self.depth = screen.root_depth
+
+    def disconnect(self):
+        self.conn.disconnect()
+
+    def set_picture(self, path: pathlib.Path, monitor: Monitor):
+        self._pictures.append((pathlib.Path(path), monitor))
+
+    def _get_atom_ids(self, *names):
+        cookies = [self.conn.core.InternAtom(False, len(name), name) for name in names]
+        return [c.reply().atom for c in cookies]
+
+    def _put_image(self, drawable, gc, x, y, width, height, data: bytes):
+        """Sends pixels without repacking them, split into requests server accepts."""
+        stride = width * 4
+        max_length = self.conn.get_maximum_request_length() * 4 - _PUT_IMAGE_HEADER.size
+        rows = max(1, max_length // stride)
+
+        for row in range(0, height, rows):
+            chunk_rows = min(rows, height - row)
+            buf = io.BytesIO()
+            buf.write(_PUT_IMAGE_HEADER.pack(
+                xcffib.xproto.ImageFormat.ZPixmap, drawable, gc,
+                width, chunk_rows, x, y + row, 0, self.depth
+            ))
+            buf.write(data[row * stride:(row + chunk_rows) * stride])
+            self.conn.core.send_request(_PUT_IMAGE_OPCODE, buf)
+
+    def write(self):
+        xproto = xcffib.xproto
+        geometry = self.conn.core.GetGeometry(self.root).reply()
+
+        pixmap = self.conn.generate_id()
+        gc = self.conn.generate_id()
+        self.conn.core.CreatePixmap(self.depth, pixmap, self.root, geometry.width, geometry.height)
+        self.conn.core.CreateGC(gc, pixmap, 0, [])
+
+        for path, monitor in self._pictures:
+            self.logger.debug("Drawing %s on %r", path, monitor)
+            data = self.cache.get(path, monitor.width, monitor.height)
+            self._put_image(pixmap, gc, monitor.x, monitor.y, monitor.width, monitor.height, data)
+        self._pictures.clear()
+
+        self.conn.core.FreeGC(gc)
+
+        root_atom, esetroot_atom = self._get_atom_ids("_XROOTPMAP_ID", "ESETROOT_PMAP_ID")
+        old = self.conn.core.GetProperty(False, self.root, esetroot_atom, xproto.Atom.PIXMAP, 0, 1).reply()
+        if old.format == 32 and old.value_len == 1:
+            self.conn.core.KillClient(struct.unpack("=I", old.value.buf())[0])
+
+        value = struct.pack("=I", pixmap)
+        for atom in (root_atom, esetroot_atom):
+            self.conn.core.ChangeProperty(xproto.PropMode.Replace, self.root, atom, xproto.Atom.PIXMAP, 32, 1, value)
+
+        self.conn.core.ChangeWindowAttributes(self.root, xproto.CW.BackPixmap, [pixmap])
+        self.conn.core.ClearArea(False, self.root, 0, 0, 0, 0)
+        self.conn.core.SetCloseDownMode(xproto.CloseDown.RetainPermanent)
+        self.conn.flush()
@@ -1,23 +1,89 @@
 import asyncio
 import dataclasses
 import logging
+import pathlib
+import types
 import typing
 from datetime import timedelta
 
 import aiostream.stream
 
-from glorpen.desktop_customizer.whereami.hints import HostHint, MonitorHint, WifiHint
+from glorpen.desktop_customizer.whereami.hints import HostHint, MonitorHint, ScreenHint, WifiHint
 from glorpen.desktop_customizer.whereami.host import hostname
 from glorpen.desktop_customizer.whereami.wifi import WifiFinder
-from glorpen.desktop_customizer.whereami.xrand import MonitorDetector, MonitorInfo
+from glorpen.desktop_customizer.whereami.xrand import EdidCache, MonitorDetector, MonitorInfo
+from glorpen.desktop_customizer.xserver import XConnection
 
 Z = typing.Type['Z']
 
 
-@dataclasses.dataclass
+_State = typing.Mapping[type[Z], typing.Union[Z, typing.Tuple[Z]]]
+
+
+@dataclasses.dataclass(frozen=True, slots=True)
+class DetectionDiff:
+    """Changes between two detection states, monitors are identified by output name and wifi by interface."""
+    monitors_added: typing.Tuple[MonitorHint, ...] = ()
+    monitors_removed: typing.Tuple[MonitorHint, ...] = ()
+    # (old, new) pairs of connected monitors with other properties than screen changed
+    monitors_changed: typing.Tuple[typing.Tuple[MonitorHint, MonitorHint], ...] = ()
+    # (output name, old, new) screens of connected monitors, None when output is disabled
+    screens_changed: typing.Tuple[typing.Tuple[str, typing.Optional[ScreenHint], typing.Optional[ScreenHint]], ...] = ()
+    # (old, new) pairs, None when interface was added or removed
+    wifi_changed: typing.Tuple[typing.Tuple[typing.Optional[WifiHint], typing.Optional[WifiHint]], ...] = ()
+    host_changed: bool = False
+
+    def __bool__(self):
+        return bool(
+            self.monitors_added or self.monitors_removed or self.monitors_changed or self.screens_changed
+            or self.wifi_changed or self.host_changed
+        )
+
+    @classmethod
+    def _index(cls, items, key):
+        return dict((key(i), i) for i in items or ())
+
+    @classmethod
+    def compare(cls, old: _State, new: _State) -> "DetectionDiff":
+        if old is new:
+            return cls()
+
+        old_monitors = cls._index((m for m in old.get(MonitorHint) or () if m.connected), lambda m: m.output_name)
+        new_monitors = cls._index((m for m in new.get(MonitorHint) or () if m.connected), lambda m: m.output_name)
+        kept = [name for name in new_monitors if name in old_monitors]
+
+        old_wifi = cls._index(old.get(WifiHint), lambda w: w.ifname)
+        new_wifi = cls._index(new.get(WifiHint), lambda w: w.ifname)
+
+        return cls(
+            monitors_added=tuple(m for name, m in new_monitors.items() if name not in old_monitors),
+            monitors_removed=tuple(m for name, m in old_monitors.items() if name not in new_monitors),
+            monitors_changed=tuple(
+                (old_monitors[name], new_monitors[name]) for name in kept
+                if dataclasses.replace(old_monitors[name], screen=None) != dataclasses.replace(new_monitors[name], screen=None)
+            ),
+            screens_changed=tuple(
+                (name, old_monitors[name].screen if name in old_monitors else None, m.screen)
+                for name, m in new_monitors.items()
+                if (old_monitors[name].screen != m.screen if name in old_monitors else m.screen is not None)
+            ) + tuple(
+                (name, m.screen, None) for name, m in old_monitors.items() if name not in new_monitors and m.screen
+            ),
+            wifi_changed=tuple(
+                (old_wifi.get(name), new_wifi.get(name)) for name in sorted(old_wifi.keys() | new_wifi.keys())
+                if old_wifi.get(name) != new_wifi.get(name)
+            ),
+            host_changed=old.get(HostHint) != new.get(HostHint),
+        )
+
+
+@dataclasses.dataclass(frozen=True, slots=True)
 class DetectionEvent:
     trigger: typing.Optional[type[Z]]
-    state: typing.Dict[type[Z], typing.Union[Z, typing.Tuple[Z]]]
+    # shared between events until one of hints changes, so ``a.state is b.state`` means nothing changed
+    state: _State
+    # changes since previously emitted event
+    diff: DetectionDiff
 
 
 class DetectionInfo(object):
@@ -25,8 +91,11 @@ class DetectionInfo(object):
 
     def __init__(
             self,
-            xrand_interval: timedelta = timedelta(seconds=5),
             wifi_interval: timedelta = timedelta(seconds=10),
+            xrand_quiet_period: timedelta = timedelta(seconds=1),
+            edid_cache_path: typing.Optional[pathlib.Path] = None,
+            x_connection: typing.Optional[XConnection] = None,
+            wifi_events=None,
     ):
         super().__init__()
         self.logger = logging.getLogger(self.__class__.__name__)
@@ -36,12 +105,16 @@ class DetectionInfo(object):
             MonitorInfo: None,
             WifiHint: None,
         }
+        self._state = types.MappingProxyType({})
 
-        self._xrand_interval = xrand_interval
         self._wifi_interval = wifi_interval
 
-        self._wifi = WifiFinder()
-        self._xrand = MonitorDetector()
+        self._wifi = WifiFinder(events=wifi_events)
+        self._xrand = MonitorDetector(
+            batch_changes=xrand_quiet_period,
+            edid_cache=EdidCache(edid_cache_path),
+            x_connection=x_connection
+        )
 
     def start(self):
         self._wifi.connect()
@@ -54,8 +127,24 @@ class DetectionInfo(object):
     def query(self):
         return tuple(self._wifi.query()), tuple(self._xrand.query()), hostname()
 
+    def _update(self, kind, value) -> bool:
+        """Stores new hint value, state snapshot is rebuilt only when it differs from current one."""
+        if self._cache[kind] == value:
+            return False
+
+        self._cache[kind] = value
+
+        hints = {}
+        for k, v in self._cache.items():
+            if k == MonitorInfo:
+                hints[MonitorHint] = tuple(i.hint for i in v) if v is not None else None
+            else:
+                hints[k] = v
+        self._state = types.MappingProxyType(hints)
+        return True
+
     async def watch(self, bootstrap_timeout: timedelta = timedelta(seconds=5)):
-        self._cache[HostHint] = hostname()
+        self._update(HostHint, hostname())
 
         async def gate():
             await asyncio.sleep(bootstrap_timeout.total_seconds())
@@ -69,29 +158,28 @@ class DetectionInfo(object):
 
         async with z.stream() as streamer:
             bootstrapped = False
+            emitted: _State = types.MappingProxyType({})
             async for trigger in streamer:
                 if not bootstrapped and trigger is None:
                     bootstrapped = True
                 if bootstrapped:
+                    diff = DetectionDiff.compare(emitted, self._state)
+                    if not diff:
+                        continue
 
-                    hints = {}
-                    for k, v in self._cache.items():
-                        if k == MonitorInfo:
-                            hints[MonitorHint] = tuple(i.hint for i in v)
-                        else:
-                            hints[k] = v
-
+                    emitted = self._state
                     yield DetectionEvent(
                         trigger=trigger,
-                        state=hints
+                        state=emitted,
+                        diff=diff
                     )
 
     async def _watch_wifi(self):
-        async for info in self._wifi.poll(self._wifi_interval):
-            self._cache[WifiHint] = info
-            yield WifiHint
+        async for info in self._wifi.watch(self._wifi_interval):
+            if self._update(WifiHint, info):
+                yield WifiHint
 
     async def _watch_xrand(self):
-        async for info in self._xrand.watch(self._xrand_interval):
-            self._cache[MonitorInfo] = info
-            yield MonitorHint
+        async for info in self._xrand.watch():
+            if self._update(MonitorInfo, info):
+                yield MonitorHint
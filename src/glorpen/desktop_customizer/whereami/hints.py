@@ -1,30 +1,32 @@
 import dataclasses
 import typing
 
+# hints are immutable, so unchanged ones can be shared between detection events and compared cheaply
 
-@dataclasses.dataclass
+
+@dataclasses.dataclass(frozen=True, slots=True)
 class HostHint:
     platform: str
     sock: str
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(frozen=True, slots=True)
 class WifiHint:
     ifname: str
     ssid: typing.Optional[str]
     mac: typing.Optional[str]
 
-@dataclasses.dataclass
+@dataclasses.dataclass(frozen=True, slots=True)
 class Position:
     x: int
     y: int
 
-@dataclasses.dataclass
+@dataclasses.dataclass(frozen=True, slots=True)
 class Size:
     width: int
     height: int
 
-@dataclasses.dataclass
+@dataclasses.dataclass(frozen=True, slots=True)
 class ScreenHint:
     position: Position
     size: Size
@@ -32,22 +34,22 @@ class ScreenHint:
 
     @property
     def x(self):
-        return self.position[0] if self.position else None
+        return self.position.x if self.position else None
 
     @property
     def y(self):
-        return self.position[1] if self.position else None
+        return self.position.y if self.position else None
 
     @property
     def width(self):
-        return self.size[0] if self.size else None
+        return self.size.width if self.size else None
 
     @property
     def height(self):
-        return self.size[1] if self.size else None
+        return self.size.height if self.size else None
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(frozen=True, slots=True)
 class MonitorHint:
     output_name: str
     width_mm: int
@@ -56,3 +58,4 @@ class MonitorHint:
     monitor_serial: typing.Optional[str]
 
     screen: typing.Optional[ScreenHint]
+    connected: bool = True
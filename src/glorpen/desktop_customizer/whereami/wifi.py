@@ -1,21 +1,89 @@
 import asyncio
 import datetime
 import logging
+import os
 import typing
 
 from pr2modules.iwutil import IW
+from pr2modules.netlink.nl80211 import NL80211
 
+from glorpen.desktop_customizer.aio import Worker, wait_readable
 from glorpen.desktop_customizer.whereami.hints import WifiHint
 
+# nl80211 commands that can change wifi association
+ASSOCIATION_EVENTS = frozenset([
+    "NL80211_CMD_CONNECT",
+    "NL80211_CMD_DISCONNECT",
+    "NL80211_CMD_ROAM",
+    "NL80211_CMD_NEW_INTERFACE",
+    "NL80211_CMD_DEL_INTERFACE",
+])
+
+
+class Nl80211Events:
+    """Subscription to nl80211 multicast groups."""
+
+    groups = ("mlme", "config")
+
+    _nl: typing.Optional[NL80211] = None
+
+    def open(self):
+        self._nl = NL80211()
+        self._nl.bind()
+        for group in self.groups:
+            self._nl.add_membership(group)
+
+    def close(self):
+        self._nl.close()
+        self._nl = None
+
+    def fileno(self) -> int:
+        return self._nl.fileno()
+
+    def read(self) -> typing.Iterable[str]:
+        return [msg.get("event") for msg in self._nl.get()]
+
+
+class FakeNl80211Events:
+    """Local event source, lets event driven mode run without wireless hardware."""
+
+    _read_fd: typing.Optional[int] = None
+    _write_fd: typing.Optional[int] = None
+
+    def open(self):
+        self._read_fd, self._write_fd = os.pipe()
+        os.set_blocking(self._read_fd, False)
+
+    def close(self):
+        os.close(self._read_fd)
+        os.close(self._write_fd)
+        self._read_fd = self._write_fd = None
+
+    def fileno(self) -> int:
+        return self._read_fd
+
+    def emit(self, event: str = "NL80211_CMD_CONNECT"):
+        os.write(self._write_fd, event.encode() + b"\n")
+
+    def read(self) -> typing.Iterable[str]:
+        try:
+            return os.read(self._read_fd, 4096).decode().split()
+        except BlockingIOError:
+            return []
+
 
 class WifiFinder:
     _running = False
     _iw: typing.Optional[IW]
+    _worker: Worker
 
-    def __init__(self):
+    def __init__(self, events=None, timeout: typing.Optional[datetime.timedelta] = datetime.timedelta(seconds=5)):
         super().__init__()
         self.logger = logging.getLogger(self.__class__.__name__)
 
+        self._events = Nl80211Events() if events is None else events
+        self._timeout = timeout
+
     def query(self):
         for name, (index, phy, mac, _unknown1, _unknown2) in self._iw.get_interfaces_dict().items():
             for data in self._iw.get_interface_by_ifindex(index):
@@ -26,12 +94,18 @@ class WifiFinder:
                     ifname=name
                 )
 
+    async def query_async(self):
+        """Runs :meth:`query` off the event loop."""
+        return await self._worker.call(lambda: tuple(self.query()))
+
     def connect(self):
+        self._worker = Worker(self.__class__.__name__, timeout=self._timeout)
         self._iw = IW()
         self._running = True
 
     def disconnect(self):
         self._running = False
+        self._worker.shutdown()
         self._iw.close()
         self._iw = None
 
@@ -39,11 +113,48 @@ class WifiFinder:
         last_data = None
         while self._running:
             try:
-                data = tuple(self.query())
+                data = await self.query_async()
                 if data != last_data:
                     last_data = data
                     yield data
                 await asyncio.sleep(interval.total_seconds())
+            except asyncio.TimeoutError:
+                self.logger.error("Timed out while querying wifi interfaces")
+                await asyncio.sleep(interval.total_seconds())
             except Exception as e:
                 self.logger.exception(e)
                 break
+
+    async def watch(self, interval: datetime.timedelta):
+        """Yields wifi state when association changes, polls with given interval if nl80211 events are unavailable."""
+        try:
+            self._events.open()
+        except Exception as e:
+            self.logger.warning("Could not subscribe to nl80211 events, falling back to polling: %s", e)
+            async for data in self.poll(interval):
+                yield data
+            return
+
+        try:
+            last_data = None
+            changed = True
+            while self._running:
+                if changed:
+                    try:
+                        data = await self.query_async()
+                    except asyncio.TimeoutError:
+                        self.logger.error("Timed out while querying wifi interfaces")
+                        # query is retried, as event which triggered it could be the only one for a while
+                        await asyncio.sleep(interval.total_seconds())
+                        continue
+                    else:
+                        if data != last_data:
+                            last_data = data
+                            yield data
+
+                await wait_readable(self._events.fileno())
+                changed = not ASSOCIATION_EVENTS.isdisjoint(self._events.read())
+        except Exception as e:
+            self.logger.exception(e)
+        finally:
+            self._events.close()
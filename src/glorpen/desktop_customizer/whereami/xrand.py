@@ -1,8 +1,10 @@
 import asyncio
 import dataclasses
 import datetime
+import hashlib
 import logging
-import os
+import pathlib
+import pickle
 import typing
 
 import pyedid
@@ -10,21 +12,131 @@ import xcffib
 import xcffib.randr
 import xcffib.xproto
 
+from glorpen.desktop_customizer.aio import Worker
 from glorpen.desktop_customizer.whereami.hints import MonitorHint, ScreenHint, Position, Size
+from glorpen.desktop_customizer.xserver import XConnection
 
 
-def get_atom_id(con, name):
-    return con.core.InternAtom(False, len(name), name).reply().atom
+# 64 as in 64 * uint32 = 256 bytes, base EDID block with one extension block
+EDID_READ_LONGS = 64
 
 
-def create_monitor_hint(output_info, edid: typing.Optional[pyedid.types.Edid]):
+@dataclasses.dataclass
+class RandrState:
+    outputs: typing.Dict[int, xcffib.randr.GetOutputInfoReply]
+    crtcs: typing.Dict[int, xcffib.randr.GetCrtcInfoReply]
+    edids: typing.Dict[int, bytes]
+
+
+def query_randr_state(ext_r: xcffib.randr.randrExtension, outputs=(), crtcs=(), edid_atom=None) -> RandrState:
+    """
+    Fetches info for given outputs and crtcs (and optionally raw EDID data).
+
+    All requests are sent before waiting for any reply, so whole batch costs a single round trip.
+    """
+    output_cookies = dict((o, ext_r.GetOutputInfo(o, 0)) for o in outputs)
+    crtc_cookies = dict((c, ext_r.GetCrtcInfo(c, 0)) for c in crtcs)
+    edid_cookies = {}
+    if edid_atom is not None:
+        edid_cookies = dict(
+            (o, ext_r.GetOutputProperty(o, edid_atom, xcffib.xproto.Atom.Any, 0, EDID_READ_LONGS, False, False))
+            for o in outputs
+        )
+
+    state = RandrState(
+        outputs=dict((k, c.reply()) for k, c in output_cookies.items()),
+        crtcs=dict((k, c.reply()) for k, c in crtc_cookies.items()),
+        edids={},
+    )
+
+    # EDIDs with more extension blocks than were requested need one more batch
+    edid_rest_cookies = {}
+    for k, c in edid_cookies.items():
+        r = c.reply()
+        state.edids[k] = bytes(r.data)
+        if r.bytes_after:
+            edid_rest_cookies[k] = ext_r.GetOutputProperty(
+                k, edid_atom, xcffib.xproto.Atom.Any,
+                len(r.data) // 4, (r.bytes_after + 3) // 4, False, False
+            )
+    for k, c in edid_rest_cookies.items():
+        state.edids[k] += bytes(c.reply().data)
+
+    return state
+
+
+class EdidCache(object):
+    """
+    Parsed EDIDs keyed by output and digest of raw EDID bytes.
+
+    Digests of already parsed EDIDs can be persisted to a file, so known monitors are not parsed again on next run.
+    """
+
+    def __init__(self, path: typing.Optional[pathlib.Path] = None):
+        super().__init__()
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self._path = path
+        self._parsed: typing.Dict[bytes, pyedid.types.Edid] = {}
+        self._outputs: typing.Dict[int, typing.Tuple[bytes, pyedid.types.Edid]] = {}
+        self._dirty = False
+
+        if path:
+            self.load()
+
+    def get(self, output: int, raw: bytes) -> typing.Optional[pyedid.types.Edid]:
+        if not raw:
+            return None
+
+        digest = hashlib.sha1(raw).digest()
+
+        known = self._outputs.get(output)
+        if known and known[0] == digest:
+            return known[1]
+
+        edid = self._parsed.get(digest)
+        if edid is None:
+            # only base block is parsed, extension blocks are only part of the digest
+            edid = pyedid.parse_edid(raw[:128])
+            self._parsed[digest] = edid
+            self._dirty = True
+
+        self._outputs[output] = (digest, edid)
+        return edid
+
+    def load(self):
+        try:
+            with self._path.open("rb") as f:
+                self._parsed.update(pickle.load(f))
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            self.logger.warning("Could not load EDID cache from %s: %s", self._path, e)
+
+    def save(self):
+        if not self._path or not self._dirty:
+            return
+
+        try:
+            self._path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self._path.with_name(self._path.name + ".tmp")
+            with tmp_path.open("wb") as f:
+                pickle.dump(self._parsed, f)
+            tmp_path.replace(self._path)
+            self._dirty = False
+        except OSError as e:
+            self.logger.warning("Could not save EDID cache to %s: %s", self._path, e)
+
+
+def create_monitor_hint(output_info, edid: typing.Optional[pyedid.types.Edid], screen: typing.Optional[ScreenHint] = None):
     return MonitorHint(
         output_name=output_info.name.raw.decode(),
         monitor_name=edid.name if edid else None,
         monitor_serial=edid.serial if edid else None,
         width_mm=output_info.mm_width,
         height_mm=output_info.mm_height,
-        screen=None
+        screen=screen,
+        connected=output_info.connection == xcffib.randr.Connection.Connected
     )
 
 
@@ -48,11 +160,16 @@ def create_screen_hint(crtc_info):
     )
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(frozen=True, slots=True)
 class MonitorInfo:
     output: int
     hint: MonitorHint
 
+    def with_screen(self, screen: typing.Optional[ScreenHint]) -> "MonitorInfo":
+        if self.hint.screen == screen:
+            return self
+        return dataclasses.replace(self, hint=dataclasses.replace(self.hint, screen=screen))
+
 _MonitorDict = typing.Dict[int, MonitorInfo]
 
 class MonitorDetector(object):
@@ -63,11 +180,26 @@ class MonitorDetector(object):
     _conn: xcffib.Connection
     _ext_r: xcffib.randr.randrExtension
     _ATOM_EDID: int
-
-    def __init__(self):
+    _worker: Worker
+
+    def __init__(
+            self,
+            batch_changes: typing.Optional[datetime.timedelta] = None,
+            edid_cache: typing.Optional[EdidCache] = None,
+            timeout: typing.Optional[datetime.timedelta] = datetime.timedelta(seconds=5),
+            x_connection: typing.Optional[XConnection] = None,
+    ):
         super().__init__()
         self.logger = logging.getLogger(self.__class__.__name__)
 
+        self._x = x_connection or XConnection()
+
+        self._edids = edid_cache or EdidCache()
+        self._timeout = timeout
+
+        if batch_changes is not None:
+            self.batch_changes_seconds = batch_changes.total_seconds()
+
         self._physical_info = {}
         self._output_info = {}
         self._pending_changes = {
@@ -77,47 +209,50 @@ class MonitorDetector(object):
 
     def connect(self):
         self.running = True
-        self._conn = xcffib.connect(os.environ.get("DISPLAY"))
-        self._ext_r = self._conn(xcffib.randr.key)
+        self._worker = Worker(self.__class__.__name__, timeout=self._timeout)
+        self._x.connect()
+        self._conn = self._x.conn
+        self._ext_r = self._x.randr
 
-        self._ATOM_EDID = get_atom_id(self._conn, "EDID")
+        self._ATOM_EDID = self._x.get_atom_id("EDID")
 
-        self._root = self._conn.get_setup().roots[0].root
+        self._root = self._x.root
 
     def disconnect(self):
         self.running = False
-        self._conn.disconnect()
-
-    def get_edid_for_output(self, output) -> pyedid.types.Edid:
-        # 32 as in 32 * uin32 = 128 edid bytes
-        d = bytes(self._ext_r.GetOutputProperty(
-            output, self._ATOM_EDID, xcffib.xproto.Atom.Any, 0, 32, False, False
-        ).reply().data)
-
-        return pyedid.parse_edid(d)
+        self._worker.shutdown()
+        self._x.disconnect()
 
     def query(self):
         screen_resources = self._ext_r.GetScreenResources(self._root).reply()
+        state = query_randr_state(
+            self._ext_r,
+            outputs=screen_resources.outputs,
+            crtcs=screen_resources.crtcs,
+            edid_atom=self._ATOM_EDID
+        )
 
         for output in screen_resources.outputs:
-            output_info = self._ext_r.GetOutputInfo(output, 0).reply()
+            output_info = state.outputs[output]
 
             edid = None
             if output_info.connection == xcffib.randr.Connection.Connected:
                 # no monitors
-                edid = self.get_edid_for_output(output)
-
-            physical_info = create_monitor_hint(output_info, edid)
-            # self._physical_info[output] = physical_info
+                edid = self._edids.get(output, state.edids[output])
 
+            screen = None
             if output_info.crtc > 0:
-                crtc_info = self._ext_r.GetCrtcInfo(output_info.crtc, 0).reply()
-                physical_info.screen = create_screen_hint(crtc_info)
-                # self._output_info[output] = screen_info
+                screen = create_screen_hint(state.crtcs[output_info.crtc])
+
+            yield MonitorInfo(output=output, hint=create_monitor_hint(output_info, edid, screen))
 
-            yield MonitorInfo(output=output, hint=physical_info)
+        self._edids.save()
 
     async def handle_event(self, ev, items: _MonitorDict):
+        return await self._worker.call(self._handle_event, ev, items)
+
+    def _handle_event(self, ev, items: _MonitorDict):
+        """Updates items with changes from event, returns None when nothing was changed."""
         # self.logger.debug(ev.__dict__)
         if not isinstance(ev, xcffib.randr.NotifyEvent):
             self.logger.debug("Got %r event", ev)
@@ -130,59 +265,92 @@ class MonitorDetector(object):
             crtc = ev.u.oc.crtc
             # rotation = ev.u.oc.rotation
 
-            e = self.get_edid_for_output(output) if is_connected else None
-            output_info = self._ext_r.GetOutputInfo(output, 0).reply()
+            has_screen = is_connected and crtc > 0 and ev.u.oc.mode > 0
+            state = query_randr_state(
+                self._ext_r,
+                outputs=[output],
+                crtcs=[crtc] if has_screen else [],
+                edid_atom=self._ATOM_EDID if is_connected else None
+            )
 
-            pi = create_monitor_hint(output_info, e)
+            e = self._edids.get(output, state.edids[output]) if is_connected else None
+            self._edids.save()
+            output_info = state.outputs[output]
 
-            if is_connected:
-                # self.update_infos(output, pi, None)
+            screen = create_screen_hint(state.crtcs[crtc]) if has_screen else None
+            info = MonitorInfo(output=output, hint=create_monitor_hint(output_info, e, screen))
 
-                if crtc > 0 and ev.u.oc.mode > 0:
-                    crtc_info = self._ext_r.GetCrtcInfo(output_info.crtc, 0).reply()
-                    pi.screen = create_screen_hint(crtc_info)
-
-            items[output] = MonitorInfo(output=output, hint=pi)
+            if items.get(output) == info:
+                return None
+            items[output] = info
             return items
 
         elif ev.subCode == xcffib.randr.Notify.CrtcChange:
             self.logger.debug("Crtc was changed")
             crtc_info = self._ext_r.GetCrtcInfo(ev.u.cc.crtc, 0).reply()
-            if ev.u.cc.mode > 0:
-                for output in crtc_info.outputs:
-                    items[output].hint.screen = create_screen_hint(crtc_info)
-            else:
-                for output in crtc_info.outputs:
-                    items[output].hint.screen = None
-
-            return items
-
-    async def watch(self, interval: datetime.timedelta):
-        self.connect()
-
-        items = dict((m.output, m) for m in self.query())
-
-        yield tuple(items.values())
-        # yield (MonitorHint, self._physical_info)
-        # yield (ScreenHint, self._output_info)
-
-        self._ext_r.SelectInput(
-            self._root,
-            xcffib.randr.NotifyMask.OutputChange |
-            xcffib.randr.NotifyMask.CrtcChange
-        )
-        self._conn.flush()
-
-        # loop = asyncio.get_event_loop()
-        # changes_timer = None
-
-        while self.running:
-            while True:
-                ev = self._conn.poll_for_event()
-                if ev is None:
-                    break
-
-                items = await self.handle_event(ev, items)
-                yield tuple(items.values())
-
-            await asyncio.sleep(interval.total_seconds())
+            screen = create_screen_hint(crtc_info) if ev.u.cc.mode > 0 else None
+
+            changed = False
+            for output in crtc_info.outputs:
+                if output in items:
+                    info = items[output].with_screen(screen)
+                    if info is not items[output]:
+                        items[output] = info
+                        changed = True
+
+            return items if changed else None
+
+    async def watch(self):
+        events = self._x.subscribe()
+
+        try:
+            snapshot = await self._worker.call(lambda: tuple(self.query()))
+            items = dict((m.output, m) for m in snapshot)
+            self._x.flush()
+
+            yield snapshot
+
+            self._x.select_randr_input(
+                xcffib.randr.NotifyMask.OutputChange |
+                xcffib.randr.NotifyMask.CrtcChange
+            )
+
+            loop = asyncio.get_running_loop()
+            # end of quiet period, set while changes are pending
+            deadline: typing.Optional[float] = None
+
+            while self.running:
+                if deadline is not None:
+                    # wait for burst of notifications (eg. from docking) to settle down before reporting
+                    try:
+                        ev = await asyncio.wait_for(events.get(), max(deadline - loop.time(), 0))
+                    except asyncio.TimeoutError:
+                        deadline = None
+                        # changes could have cancelled each other out
+                        current = tuple(items.values())
+                        if current != snapshot:
+                            snapshot = current
+                            yield snapshot
+                        continue
+                else:
+                    ev = await events.get()
+
+                # other subscribers of shared connection receive their own events,
+                # they do not extend quiet period
+                if not isinstance(ev, xcffib.randr.NotifyEvent):
+                    continue
+
+                try:
+                    changed = await self.handle_event(ev, items)
+                except asyncio.TimeoutError:
+                    self.logger.error("Timed out while handling %r", ev)
+                    continue
+                finally:
+                    self._x.flush()
+
+                if changed is not None:
+                    items = changed
+                if changed is not None or deadline is not None:
+                    deadline = loop.time() + self.batch_changes_seconds
+        finally:
+            self._x.unsubscribe(events)
@@ -0,0 +1,137 @@
+import asyncio
+import logging
+import os
+import typing
+
+import xcffib
+import xcffib.randr
+
+from glorpen.desktop_customizer.aio import wait_readable
+
+
+class XConnection(object):
+    """
+    X connection shared by all components.
+
+    Atoms are interned once and events are dispatched to every subscriber queue.
+    """
+
+    conn: typing.Optional[xcffib.Connection] = None
+    randr: xcffib.randr.randrExtension
+    root: int
+
+    def __init__(self, display: typing.Optional[str] = None):
+        super().__init__()
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self._display = display
+        self._users = 0
+        self._atoms: typing.Dict[str, int] = {}
+        self._randr_mask = 0
+        self._subscribers: typing.List[asyncio.Queue] = []
+        self._dispatcher: typing.Optional[asyncio.Future] = None
+        self._wakeup: typing.Optional[asyncio.Event] = None
+
+    def connect(self):
+        """Opens connection on first use, every call should be paired with :meth:`disconnect`."""
+        self._users += 1
+        if self.conn is not None:
+            return
+
+        self.conn = xcffib.connect(self._display or os.environ.get("DISPLAY"))
+        self.randr = self.conn(xcffib.randr.key)
+        self.root = self.conn.get_setup().roots[0].root
+
+    def disconnect(self):
+        self._users -= 1
+        if self._users > 0 or self.conn is None:
+            return
+
+        if self._dispatcher:
+            self._dispatcher.cancel()
+            self._dispatcher = None
+
+        self.conn.disconnect()
+        self.conn = None
+        self._atoms.clear()
+        self._randr_mask = 0
+
+    def get_atom_id(self, name: str) -> int:
+        return self.get_atom_ids(name)[0]
+
+    def get_atom_ids(self, *names: str) -> typing.Tuple[int, ...]:
+        """Interns all unknown atoms in a single round trip."""
+        cookies = dict(
+            (name, self.conn.core.InternAtom(False, len(name), name))
+            for name in names if name not in self._atoms
+        )
+        for name, cookie in cookies.items():
+            self._atoms[name] = cookie.reply().atom
+
+        return tuple(self._atoms[name] for name in names)
+
+    def select_randr_input(self, mask: int):
+        """Adds RandR notifications to selected ones, selecting only given mask would override other subscribers."""
+        self._randr_mask |= mask
+        self.randr.SelectInput(self.root, self._randr_mask)
+        self.flush()
+
+    def flush(self):
+        """
+        Sends pending requests and checks for events.
+
+        Waiting for replies could have moved events to xcb queue without waking up the dispatcher,
+        so it should be called after handling events or finishing calls made in worker threads.
+        """
+        self.conn.flush()
+        if self._wakeup:
+            self._wakeup.set()
+
+    def subscribe(self) -> asyncio.Queue:
+        queue = asyncio.Queue()
+        self._subscribers.append(queue)
+
+        if self._dispatcher is None:
+            self._dispatcher = asyncio.ensure_future(self._dispatch())
+
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self._subscribers.remove(queue)
+
+    async def _wait_for_data(self, fd):
+        await wait_readable(fd)
+        self._wakeup.set()
+
+    async def _dispatch(self):
+        self._wakeup = asyncio.Event()
+        fd = self.conn.get_file_descriptor()
+        reader = asyncio.ensure_future(self._wait_for_data(fd))
+
+        try:
+            while True:
+                self._wakeup.clear()
+
+                while True:
+                    try:
+                        ev = self.conn.poll_for_event()
+                    except xcffib.Error as e:
+                        # errors from requests without replies, eg. for already destroyed windows
+                        self.logger.debug("Ignoring error %r", e)
+                        continue
+
+                    if ev is None:
+                        break
+
+                    for queue in self._subscribers:
+                        queue.put_nowait(ev)
+
+                self.conn.flush()
+
+                if reader.done():
+                    reader = asyncio.ensure_future(self._wait_for_data(fd))
+
+                await self._wakeup.wait()
+        finally:
+            reader.cancel()
+            self._wakeup = None
@@ -0,0 +1,21 @@
+import types
+
+from jinja2 import Environment
+
+from glorpen.desktop_customizer.config.selectors import Selector, SelectorIndex
+
+
+def test_in_string_is_substring_test():
+    selector = Selector.compile(Environment(), 'wifi.ssid in "HomeNet-5G HomeNet"')
+
+    assert not selector.exact
+    assert selector(wifi=types.SimpleNamespace(ssid="HomeNet"))
+    assert list(SelectorIndex({"home": selector}).match(wifi=types.SimpleNamespace(ssid="HomeNet"))) == ["home"]
+
+
+def test_in_list_is_exact():
+    selector = Selector.compile(Environment(), 'wifi.ssid in ["HomeNet-5G", "HomeNet"]')
+
+    assert selector.exact
+    assert selector(wifi=types.SimpleNamespace(ssid="HomeNet"))
+    assert not selector(wifi=types.SimpleNamespace(ssid="Home"))
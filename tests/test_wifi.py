@@ -0,0 +1,44 @@
+import asyncio
+import datetime
+
+from glorpen.desktop_customizer.aio import Worker
+from glorpen.desktop_customizer.whereami.hints import WifiHint
+from glorpen.desktop_customizer.whereami.wifi import FakeNl80211Events, WifiFinder
+
+
+class StaticWifiFinder(WifiFinder):
+    def __init__(self, events):
+        super().__init__(events=events)
+        self.hints = ()
+
+    def query(self):
+        return self.hints
+
+    def connect(self):
+        self._worker = Worker(self.__class__.__name__, timeout=self._timeout)
+        self._running = True
+
+    def disconnect(self):
+        self._running = False
+        self._worker.shutdown()
+
+
+def test_watch_queries_on_association_events():
+    events = FakeNl80211Events()
+    finder = StaticWifiFinder(events)
+
+    async def run():
+        finder.connect()
+        watch = finder.watch(datetime.timedelta(hours=1))
+        try:
+            assert await watch.__anext__() == ()
+
+            finder.hints = (WifiHint(ssid="HomeNet", mac=None, ifname="wlan0"),)
+            events.emit("NL80211_CMD_CONNECT")
+
+            assert await asyncio.wait_for(watch.__anext__(), 5) == finder.hints
+        finally:
+            await watch.aclose()
+            finder.disconnect()
+
+    asyncio.run(run())